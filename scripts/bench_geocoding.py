@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# BENCHMARK FOR THE REVERSE GEOCODING SCHEDULER AGAINST A LOCAL STAND-IN NOMINATIM SERVER
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.parse
+import http.server
+
+#--------------
+# other imports
+# -------------
+
+from tessutils.geocoding import NominatimBackend, Scheduler
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def createParser():
+    parser = argparse.ArgumentParser(prog=sys.argv[0], description="Reverse geocoding scheduler benchmark")
+    parser.add_argument('-n', '--requests', type=int, default=50, help='number of reverse lookups')
+    parser.add_argument('--latency', type=float, default=0.2, help='stand-in server mean latency in seconds')
+    parser.add_argument('--failures', type=float, default=0.1, help='stand-in server 503 error probability')
+    parser.add_argument('--rate', type=float, default=10.0, help='scheduler requests per second')
+    parser.add_argument('--workers', type=int, default=4, help='scheduler concurrent requests')
+    parser.add_argument('--retries', type=int, default=3, help='scheduler retries')
+    parser.add_argument('--timeout', type=float, default=2.0, help='request timeout in seconds')
+    return parser
+
+
+def handler_factory(latency, failures):
+
+    class StandInHandler(http.server.BaseHTTPRequestHandler):
+        '''Answers /reverse requests like Nominatim does, with random latency and failures'''
+
+        def do_GET(self):
+            time.sleep(random.expovariate(1/latency) if latency else 0)
+            if random.random() < failures:
+                self.send_error(503)
+                return
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            body = json.dumps({
+                'lat': query['lat'][0],
+                'lon': query['lon'][0],
+                'display_name': 'Stand-in place',
+                'address': {'amenity': f"Place at {query['lat'][0]}, {query['lon'][0]}", 'country': 'Nowhere'},
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return StandInHandler
+
+
+def main():
+    options = createParser().parse_args(sys.argv[1:])
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler_factory(options.latency, options.failures))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    backend = NominatimBackend(url, timeout=options.timeout)
+    scheduler = Scheduler(backend, rate=options.rate, workers=options.workers, retries=options.retries, backoff=0.1)
+    coordinates = [(40.0 + i*1e-3, -3.0 - i*1e-3) for i in range(options.requests)]
+    t0 = time.perf_counter()
+    results = list(scheduler.map(coordinates, lambda item: scheduler.submit(item[0], item[1], 'en')))
+    elapsed = time.perf_counter() - t0
+    scheduler.close()
+    server.shutdown()
+    failed = sum(1 for item, address in results if address is None)
+    print(f"{len(results)} lookups in {elapsed:.2f} s ({len(results)/elapsed:.1f} lookups/s), {failed} failed")
+    print(f"rate limit {options.rate}/s, {options.workers} workers, server latency {options.latency} s, failure rate {options.failures}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# BENCHMARK FOR THE 'location generate' SPREADSHEET FILTERING PASSES
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import csv
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import collections
+
+#--------------
+# other imports
+# -------------
+
+from tessutils.utils import open_database
+from tessutils.location import fieldnames, deployment_list, database_index, hash_rows, conflicting_photometers, classify
+
+# ----------------
+# Module constants
+# ----------------
+
+DEFAULT_SIZES = "1000,10000,20000,40000"
+DEFAULT_HISTORY = 3 # spreadsheet rows per photometer (historical deployments)
+
+SCHEMA = '''
+    CREATE TABLE location_t (location_id INTEGER PRIMARY KEY, site TEXT, location TEXT);
+    CREATE TABLE tess_t (tess_id INTEGER PRIMARY KEY, name TEXT, mac_address TEXT, valid_state TEXT, location_id INTEGER);
+    CREATE VIEW tess_v AS SELECT * FROM tess_t JOIN location_t USING (location_id);
+    INSERT INTO location_t VALUES (-1, 'Unknown', 'Unknown');
+    '''
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def createParser():
+    parser = argparse.ArgumentParser(prog=sys.argv[0], description="location generate scaling benchmark")
+    parser.add_argument('-s', '--sizes', type=str, default=DEFAULT_SIZES, help='comma-separated list of photometer counts')
+    parser.add_argument('-r', '--history', type=int, default=DEFAULT_HISTORY, help='spreadsheet rows per photometer')
+    return parser
+
+
+def make_database(path, size):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    connection.executemany(
+        "INSERT INTO tess_t (name, mac_address, valid_state, location_id) VALUES (?, ?, 'Current', -1)",
+        ((f"stars{i}", ":".join(f"{i:012X}"[j:j+2] for j in range(0, 12, 2))) for i in range(1, size+1)))
+    connection.commit()
+    connection.close()
+
+
+def make_spreadsheet(path, size, history):
+    '''Every photometer gets several rows, some with invalid coordinates or empty site names'''
+    with open(path, 'w', newline='') as fd:
+        writer = csv.writer(fd)
+        writer.writerow(['#', 'stars', 'Longitud', 'Latitud', 'MSNM', 'Nombre lugar'])
+        for i in range(1, size+1):
+            for j in range(history):
+                longitude = 'N/A' if (i + j) % 17 == 0 else f"{-3.7 + i*1e-5:.6f}"
+                site = '' if i % 10 == 0 else f"Site {i}"
+                writer.writerow([i, f"stars{i}", longitude, "40.4", 650, site])
+
+
+def filtering(dbase, sheet, headers):
+    '''The two spreadsheet passes of location generate, as it runs them, without the output files'''
+    connection = open_database(dbase, read_only=True)
+    index = database_index(connection)
+    hashes = dict()
+    conflict = conflicting_photometers(hash_rows(deployment_list(sheet, headers), index, hashes), index)
+    counters = collections.Counter()
+    invalid = list()
+    geocoder_queue = list()
+    valid = list(classify(deployment_list(sheet, headers), index, conflict, invalid.append, geocoder_queue.append, counters))
+    connection.close()
+    return valid, geocoder_queue, invalid
+
+
+def main():
+    options = createParser().parse_args(sys.argv[1:])
+    sizes = [int(size) for size in options.sizes.split(',')]
+    print(f"{'photometers':>12} {'rows':>10} {'seconds':>10} {'rows/s':>12}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            dbase = os.path.join(tmpdir, f"tess-{size}.db")
+            sheet = os.path.join(tmpdir, f"sheet-{size}.csv")
+            make_database(dbase, size)
+            make_spreadsheet(sheet, size, options.history)
+            headers = fieldnames(sheet)
+            t0 = time.perf_counter()
+            filtering(dbase, sheet, headers)
+            elapsed = time.perf_counter() - t0
+            rows = size * options.history
+            print(f"{size:>12} {rows:>10} {elapsed:>10.3f} {rows/elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
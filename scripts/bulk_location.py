@@ -25,7 +25,7 @@ import logging
 # other imports
 # -------------
 
-import jinja2
+from tessutils.utils import render
 
 # ----------------
 # Module constants
@@ -122,21 +122,12 @@ def select_data(data, lower, upper):
 
 
 
-def render(template_path, context):
-    if not os.path.exists(template_path):
-        raise IOError("No Jinja2 template file found at {0}. Exiting ...".format(template_path))
-    path, filename = os.path.split(template_path)
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path or './')
-    ).get_template(filename).render(context)
-
 
 def main():
     data = unicode_csv_reader(DEFAULT_FILE)
     rows = select_data(data, 1, 1000)
     context = dict()
     context['locations'] = rows
-    script = render(DEFAULT_TPLT, context)
-    print(script)
+    render(DEFAULT_TPLT, context, sys.stdout)
 
 main()
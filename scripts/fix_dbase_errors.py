@@ -34,7 +34,7 @@ import shlex
 import subprocess
 
 
-import jinja2
+from tessutils.utils import render, open_database
 
 # ----------------
 # Module constants
@@ -57,11 +57,6 @@ DEFAULT_DIR  = "/var/dbase/reports/IDA"
 def utf8(s):
     return unicode(s, 'utf8')
 
-def open_database(options):
-    if not os.path.exists(options.dbase):
-        raise IOError("No SQLite3 Database file found in {0}. Exiting ...".format(options.dbase))
-    return sqlite3.connect(options.dbase)
- 
 
 
 def createParser():
@@ -81,14 +76,6 @@ def increment(context, topic, key):
     return context
 
 
-def render(template_path, context):
-    if not os.path.exists(template_path):
-        raise IOError("No Jinja2 template file found at {0}. Exiting ...".format(template_path))
-    path, filename = os.path.split(template_path)
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path or './')
-    ).get_template(filename).render(context)
-
 
 def insert_row(row, cursor, context):     
     try:
@@ -150,7 +137,7 @@ def main():
 
     options = createParser().parse_args(sys.argv[1:])
     regexps   = [ re.compile(item) for item in [LINE1, LINE2] ]
-    connection = open_database(options)
+    connection = open_database(options.dbase)
     cursor = connection.cursor()
     for line in open(options.input_file):
         context = process_data(regexps, line, cursor, context)
@@ -160,8 +147,7 @@ def main():
     connection.commit()
     context['database'] = options.reports_dbase
     context['out_dir']  = options.out_dir
-    script = render(DEFAULT_TPLT, context).encode('utf-8')
-    print(script)
+    render(DEFAULT_TPLT, context, sys.stdout)
 
 
 
@@ -30,7 +30,8 @@ import subprocess
 # other imports
 # -------------
 
-import jinja2
+from tessutils.utils import render, open_database
+from tessutils.registry import registry
 
 # ----------------
 # Module constants
@@ -63,25 +64,9 @@ KEYS = [
   
 
 
-def open_database():
-    if not os.path.exists(CURRENT_DATABASE):
-        raise IOError("No SQLite3 Database file found in {0}. Exiting ...".format(CURRENT_DATABASE))
-    return sqlite3.connect(CURRENT_DATABASE)
- 
 
 def get_instruments_from_db(connection):
-    cursor = connection.cursor()
-    cursor.execute(
-            '''
-            SELECT name,mac_address
-            FROM tess_t
-            WHERE valid_state == "Current"
-            AND name LIKE "stars%"
-            ORDER BY name ASC;
-            ''')
-    result = cursor.fetchall()
-    result = { name: mac for name, mac in result }
-    return result
+    return registry(connection).mac_addresses()
 
 
 # ====== SELECTING TESS BY INDEX NUMBER
@@ -140,22 +125,11 @@ def select_data(data, lower, upper):
 
 # =================
 
-def render(template_path, context):
-    if not os.path.exists(template_path):
-        raise IOError("No Jinja2 template file found at {0}. Exiting ...".format(template_path))
-    path, filename = os.path.split(template_path)
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path or './')
-    ).get_template(filename).render(context)
-
-# =================
-
 def main():
     context = dict()
     data = unicode_csv_reader(DEFAULT_FILE)
     context['excel'] = select_data(data, 1, 1000)
-    context['dbase'] = get_instruments_from_db(open_database())
-    script = render(DEFAULT_TPLT, context).encode('utf-8')
-    print(script)
+    context['dbase'] = get_instruments_from_db(open_database(CURRENT_DATABASE, read_only=True))
+    render(DEFAULT_TPLT, context, sys.stdout)
 
 main()
@@ -17,6 +17,9 @@ import os
 import os.path
 import sys
 import argparse
+import functools
+import itertools
+import collections
 import sqlite3
 import datetime
 import time
@@ -35,7 +38,11 @@ import logging as log
 # other imports
 # -------------
 
-#from . import __version__
+from tessutils.registry import registry
+from tessutils.readings import ReadingsScanner, DEFAULT_CHUNK_SIZE, DEFAULT_WORKERS, parallel_scan, database_file, photometer_readings
+from tessutils.purge import window_victims, victims, array_victims, apply_deletes, render_sql, render_range, coalesce, ScriptWriter, Telemetry, chunk_path
+from tessutils.purge import WINDOW_ENGINE_PRAGMAS, DEFAULT_BATCH_SIZE, DEFAULT_TRACE_FIRST, DEFAULT_TRACE_EVERY
+from tessutils.utils import open_database, snapshot, SNAPSHOT_MODES, DEFAULT_SNAPSHOT_PAGES, DEFAULT_SNAPSHOT_SLEEP
 
 
 # ----------------
@@ -47,12 +54,20 @@ DEFAULT_FILE  = "purge_zeros.sql"
 
 FIFO_DEPTH = 7
 
+ENGINES = ('fifo', 'sql', 'numpy')
+
 # ----------------
 # Global variables
 # ----------------
 
 gFIFO = deque(maxlen=FIFO_DEPTH)
 
+# Telemetry of the photometer being filtered
+gTelemetry = Telemetry()
+
+# First tess_id of a single scan whose deletes may not be written or committed yet
+gResumeFrom = None
+
 # -----------------------
 # Module global functions
 # -----------------------
@@ -61,10 +76,31 @@ gFIFO = deque(maxlen=FIFO_DEPTH)
 def createParser():
     # create the top-level parser
     parser = argparse.ArgumentParser(prog=sys.argv[0], description="TESS Zero Purge " )
-    parser.add_argument('file', metavar='<SQL file>', help='Output file to dump SQL statements')
+    parser.add_argument('file', metavar='<SQL file>', nargs='?', default=None, help='Output file to dump SQL statements, gzipped if it ends in .gz')
+    parser.add_argument('--no-ranges', dest='ranges', action='store_false', help='one DELETE per reading instead of one per run of consecutive readings')
+    parser.add_argument('--split', type=int, default=None, metavar='<N>', help='start a new numbered SQL file, with its own transaction, every N statements')
     parser.add_argument('-d', '--dbase', default=DEFAULT_DBASE, help='SQLite database full file path')
     parser.add_argument('-v', '--verbose',  action='store_true', help='verbose log level')
     parser.add_argument('-n', '--name', type=str, help='comma-separated list of TESS-W names for specific filtering')
+    parser.add_argument('-s', '--snapshot', choices=SNAPSHOT_MODES, default='none', help='read from a pinned WAL transaction or a backup copy so the tessdb writer is never stalled')
+    parser.add_argument('--snapshot-pages', type=int, default=DEFAULT_SNAPSHOT_PAGES, help='pages copied per backup step')
+    parser.add_argument('--snapshot-sleep', type=float, default=DEFAULT_SNAPSHOT_SLEEP, help='seconds to sleep between backup steps')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='readings fetched per query')
+    parser.add_argument('--since', type=int, default=None, metavar='<YYYYMMDD>', help='only readings from this date_id onwards')
+    parser.add_argument('--until', type=int, default=None, metavar='<YYYYMMDD>', help='only readings up to this date_id')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help='photometers scanned in parallel processes (default: %(default)s)')
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='fifo', help='fifo: sliding window in Python, sql: SQLite window functions, numpy: vectorized (default: %(default)s)')
+    parser.add_argument('--verify', action='store_true', help='check that the chosen engine finds the same readings as the fifo one')
+    parser.add_argument('--trace-all', action='store_true', help='log every reading instead of aggregated telemetry with sampled traces')
+    parser.add_argument('--trace-first', type=int, default=DEFAULT_TRACE_FIRST, help='readings traced at the start of every photometer (default: %(default)s)')
+    parser.add_argument('--trace-every', type=int, default=DEFAULT_TRACE_EVERY, help='then trace one reading out of this many (default: %(default)s)')
+    parser.add_argument('--telemetry', type=str, default=None, metavar='<JSON file>', help='also write the telemetry summary and sampled traces as JSON')
+    parser.add_argument('--single-scan', action='store_true', help='scan all readings at once, in tess_id order, with the fifo or numpy engines')
+    parser.add_argument('--resume-from', type=int, default=None, metavar='<tess_id>', help='start a single scan at this tess_id')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--apply', action='store_true', help='delete the readings directly instead of writing an SQL file')
+    group.add_argument('--dry-run', action='store_true', help='only report how many readings would be deleted per photometer')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='readings deleted per transaction with --apply (default: %(default)s)')
     return parser
 
 
@@ -76,13 +112,6 @@ def createParser():
 # GENERIC DATABASE FUNCTIONS
 # --------------------------
 
-def open_database(dbase_path):
-    if not os.path.exists(dbase_path):
-       raise IOError("No SQLite3 Database file found at {0}. Exiting ...".format(dbase_path))
-    log.info("Opening database %s", dbase_path)
-    return sqlite3.connect(dbase_path)
-
-
 def result_generator(cursor, arraysize=500):
     'An iterator that uses fetchmany to keep memory usage down'
     while True:
@@ -97,42 +126,12 @@ def result_generator(cursor, arraysize=500):
 # ---------------------------
 
 def get_photometer_list(connection):
-    cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT DISTINCT name
-        FROM tess_t
-        ORDER BY name ASC;
-        ''')
-    return [ item[0] for item in cursor.fetchall() ]
-
-
-def fetch_all_dbreadings(connection, name):
-    '''From start of month at midnight UTC'''
-    row = {'name': name}
-    cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT r.date_id, r.time_id, r.tess_id, r.sequence_number, r.frequency, r.magnitude
-        FROM tess_readings_t as r
-        JOIN tess_t     as i USING (tess_id)
-        WHERE i.name == :name
-        ORDER BY r.date_id ASC, r.time_id ASC
-        ''', row)
-    return cursor
+    return registry(connection).names()
 
 
-# -------------------
-# AUXILIARY FUNCTIONS
-# -------------------
-def render_sql(data):
-    date_id = data[0]
-    time_id = data[1]
-    tess_id = data[2]
-    seqno   = data[3]
-    freq    = data[4]
-    mag     = data[5]
-    return ("DELETE FROM tess_readings_t WHERE date_id == {0} AND time_id == {1} AND tess_id == {2}; -- seq {3} freq {4} mag{5}\n".format(date_id, time_id, tess_id, seqno, freq, mag))
+def fetch_all_dbreadings(connection, name, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''All readings of a photometer in time order, merging the chunked scans of all its tess_id'''
+    return photometer_readings(connection, name, since, until, chunk_size)
 
 
 # -------------------
@@ -167,21 +166,23 @@ def is_sequence_invalid(aList):
        
 def trace_reading(name, reading, discard):
     mark = "+++" if not discard else "---"
-    log.info("[%s] (%02d) [%08dT%06d] [%06d] f=%s, m=%s -> %s", name, reading[2], reading[0], reading[1], reading[3], reading[4], reading[5], mark)
+    if gTelemetry.trace(name, reading, mark):
+        log.info("[%s] (%02d) [%08dT%06d] [%06d] f=%s, m=%s -> %s", name, reading[2], reading[0], reading[1], reading[3], reading[4], reading[5], mark)
 
 def debug_reading(name, reading, msg):
-    log.debug("[%s] (%02d) [%08dT%06d] [%06d] f=%s, m=%s -> %s", name, reading[2], reading[0], reading[1], reading[3], reading[4], reading[5], msg)
+    if gTelemetry.trace(name, reading, msg):
+        log.debug("[%s] (%02d) [%08dT%06d] [%06d] f=%s, m=%s -> %s", name, reading[2], reading[0], reading[1], reading[3], reading[4], reading[5], msg)
 
 
 def filter_reading(name, row):
         gFIFO.append(row)
         if len(gFIFO) <= FIFO_DEPTH//2:
-            log.debug("[%s] Refilling the buffer", name)
             return None
-        seqList   = [ item[3]  for item in gFIFO ]
-        freqList  = [ item[4]  for item in gFIFO ]
         magList  =  [ item[5]  for item in gFIFO ]
-        log.debug("%s: seqList = %s. freqList = %s, magList =%s", name, seqList, freqList, magList)
+        if gTelemetry.log_all and log.getLogger().isEnabledFor(log.DEBUG):
+            seqList   = [ item[3]  for item in gFIFO ]
+            freqList  = [ item[4]  for item in gFIFO ]
+            log.debug("%s: seqList = %s. freqList = %s, magList =%s", name, seqList, freqList, magList)
         chosen_row = gFIFO[FIFO_DEPTH//2]
         if  is_sequence_invalid(magList):
             discard = True
@@ -194,6 +195,7 @@ def filter_reading(name, row):
               
 
 def flush_filter(name):
+    gTelemetry.count(name, 'flushed', len(gFIFO))
     while len(gFIFO) > FIFO_DEPTH//2:
         row = gFIFO.popleft()
         debug_reading(name, row, "--- (dupl)")
@@ -202,6 +204,147 @@ def flush_filter(name):
         trace_reading(name, row, False)
 
 
+def fifo_victims(name, readings, telemetry):
+    '''Invalid readings among the readings of a photometer in time order, found with the FIFO filter'''
+    global gTelemetry
+    gTelemetry = telemetry
+    t0 = time.perf_counter()
+    result = list()
+    # Readings are followed by their position among the readings of their tess_id, as the other engines do
+    positions = collections.Counter()
+    for reading in readings:
+        position = positions[reading[2]]
+        positions[reading[2]] += 1
+        new_reading = filter_reading(name, reading + (position,))
+        if new_reading:
+            result.append(new_reading)
+    flush_filter(name)
+    telemetry.photometer(name, result, time.perf_counter() - t0, sum(positions.values()))
+    return result
+
+
+def numpy_victims(name, readings, telemetry):
+    t0 = time.perf_counter()
+    readings = list(readings)
+    result = list(array_victims(readings))
+    telemetry.photometer(name, result, time.perf_counter() - t0, len(readings))
+    return result
+
+
+def purge_photometer(connection, name, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE, trace=(), analysis=fifo_victims):
+    '''
+    Invalid readings of a photometer, found with the FIFO filter by default,
+    together with the telemetry gathered meanwhile
+    '''
+    telemetry = Telemetry(*trace)
+    result = analysis(name, fetch_all_dbreadings(connection, name, since, until, chunk_size), telemetry)
+    return result, telemetry
+
+
+def trace_options(options):
+    return (options.trace_first, options.trace_every, options.trace_all)
+
+
+def fifo_engine(connection, options, tess_names, telemetry, analysis=fifo_victims):
+    # Workers read the snapshot copy if any, each pinning its own WAL snapshot if asked to
+    path = database_file(connection)
+    mode = 'wal' if options.snapshot == 'wal' else 'none'
+    task = functools.partial(purge_photometer, since=options.since, until=options.until, chunk_size=options.chunk_size,
+        trace=trace_options(options), analysis=analysis)
+    for name, (result, photometer_telemetry) in parallel_scan(path, tess_names, task, options.workers, mode):
+        telemetry.merge(photometer_telemetry)
+        yield name, result
+
+
+def numpy_engine(connection, options, tess_names, telemetry):
+    return fifo_engine(connection, options, tess_names, telemetry, numpy_victims)
+
+
+def sql_engine(connection, options, tess_names, telemetry):
+    t0 = time.perf_counter()
+    window_victims(connection, None if options.name is None else tess_names, options.since, options.until)
+    # Time spent finding the readings is shared among all photometers
+    seconds = (time.perf_counter() - t0) / max(len(tess_names), 1)
+    for name in tess_names:
+        result = list(victims(connection, name))
+        telemetry.photometer(name, result, seconds)
+        yield name, result
+
+
+def single_scan(connection, options, tess_names, telemetry):
+    '''
+    A single scan of tess_readings_t in (tess_id, date_id, time_id) order for all photometers,
+    instead of one query per name. The sliding window is reset on every tess_id change,
+    so each tess_id of a photometer is filtered on its own.
+    '''
+    analysis = SCAN_ANALYSIS[options.engine]
+    trace = trace_options(options)
+    names = dict()
+    for name in tess_names:
+        for tess_id in registry(connection).tess_ids(name):
+            names[tess_id] = name
+    if not names:
+        return
+    first = min(names) if options.resume_from is None else options.resume_from
+    scanner = ReadingsScanner(connection, first=first, last=max(names), since=options.since, until=options.until, chunk_size=options.chunk_size)
+    global gResumeFrom
+    for tess_id, readings in itertools.groupby(scanner, key=lambda reading: reading[2]):
+        # Every tess_id before this one has been handed over to the output
+        gResumeFrom = tess_id
+        name = names.get(tess_id)
+        if name is not None:
+            photometer_telemetry = Telemetry(*trace)
+            result = analysis(name, readings, photometer_telemetry)
+            telemetry.merge(photometer_telemetry)
+            yield name, result
+
+
+ENGINE_FUNCTIONS = {'fifo': fifo_engine, 'sql': sql_engine, 'numpy': numpy_engine}
+
+SCAN_ANALYSIS = {'fifo': fifo_victims, 'numpy': numpy_victims}
+
+
+def verify(connection, options, tess_names):
+    '''Checks that the chosen engine finds the same readings as the fifo one, photometer by photometer'''
+    mismatches = 0
+    engine = ENGINE_FUNCTIONS[options.engine]
+    fifo_results = fifo_engine(connection, options, tess_names, Telemetry())
+    results = engine(connection, options, tess_names, Telemetry())
+    for (name, fifo_readings), (_, readings) in zip(fifo_results, results):
+        if fifo_readings != readings:
+            mismatches += 1
+            log.error("[%s] engines differ: fifo found %d readings, %s found %d", name, len(fifo_readings), options.engine, len(readings))
+    if mismatches:
+        raise ValueError("{0} photometers purged differently by the fifo and {1} engines".format(mismatches, options.engine))
+    log.info("The fifo and %s engines agree on %d photometers", options.engine, len(tess_names))
+
+
+def write_script(path, results, ranges=True, split=None):
+    '''
+    SQL script deleting the invalid readings, by (date_id, time_id) ranges unless told otherwise.
+    Optionally gzipped and split in several files, each one a transaction.
+    '''
+    with ScriptWriter(path, split) as writer:
+        for name, readings in results:
+            writer.comment("deleting {0} invalid readings".format(name))
+            if ranges:
+                for run in coalesce(readings):
+                    writer.delete(render_range(*run))
+            else:
+                for reading in readings:
+                    writer.delete(render_sql(reading))
+    log.info("%d DELETE statements written in %d files", writer.statements, writer.files)
+
+
+def dry_run(results):
+    total = 0
+    for name, readings in results:
+        count = len(set(readings))
+        total += count
+        print("{0}: {1} readings to delete".format(name, count))
+    print("Total: {0} readings to delete".format(total))
+
+
 # =============
 # MAIN FUNCTION
 # =============
@@ -211,31 +354,54 @@ def main():
     Utility entry point
     '''
     try:
-        options = createParser().parse_args(sys.argv[1:])
+        parser = createParser()
+        options = parser.parse_args(sys.argv[1:])
+        if options.file is None and not (options.apply or options.dry_run):
+            parser.error("an SQL file is needed unless --apply or --dry-run are given")
+        if options.single_scan and options.engine not in SCAN_ANALYSIS:
+            parser.error("--single-scan works with the fifo and numpy engines only")
+        if options.single_scan and options.verify:
+            parser.error("--verify checks the per photometer engines, not --single-scan")
+        if options.resume_from is not None and options.file is not None:
+            # The interrupted run wrote its own script, which holds the deletes before the resume point
+            for path in (options.file, chunk_path(options.file, 1)):
+                if os.path.exists(path):
+                    parser.error("--resume-from would overwrite {0} from the interrupted run, write to another file or use --apply".format(path))
         level = log.DEBUG if options.verbose else log.INFO
         log.basicConfig(level=level, format='%(name)s - %(levelname)s - %(message)s')
-        connection = open_database(options.dbase)
-        if options.name is None:
-            tess_names = get_photometer_list(connection)
-        else:
-            tess_names = chop(options.name, ',')
-        with open(options.file, 'w') as outfile:
-            outfile.write("BEGIN TRANSACTION;\n")
-            for name in tess_names:
-                outfile.write("-- deleting {0} invalid readings\n".format(name))
-                cursor = fetch_all_dbreadings(connection, name)
-                for reading in result_generator(cursor):
-                    new_reading = filter_reading(name, reading)
-                    if new_reading:
-                        sql = render_sql(new_reading)
-                        outfile.write(sql)
-                flush_filter(name)
-            outfile.write("COMMIT;\n")
+        log.info("Opening database %s", options.dbase)
+        pragmas = WINDOW_ENGINE_PRAGMAS if options.engine == 'sql' else None
+        with snapshot(options.dbase, options.snapshot, options.snapshot_pages, options.snapshot_sleep, pragmas) as connection:
+            if options.name is None:
+                tess_names = get_photometer_list(connection)
+            else:
+                tess_names = chop(options.name, ',')
+            if options.verify:
+                verify(connection, options, tess_names)
+            engine = single_scan if options.single_scan else ENGINE_FUNCTIONS[options.engine]
+            telemetry = Telemetry()
+            t0 = time.perf_counter()
+            results = engine(connection, options, tess_names, telemetry)
+            if options.dry_run:
+                dry_run(results)
+            elif options.apply:
+                writer = open_database(options.dbase)
+                apply_deletes(writer, results, options.batch_size)
+                writer.close()
+            else:
+                write_script(options.file, results, options.ranges, options.split)
+            log.info("Purge done in %.1f seconds", time.perf_counter() - t0)
+            print(telemetry.table())
+            if options.telemetry:
+                telemetry.save(options.telemetry)
             
     except KeyboardInterrupt:
         print('Interrupted by user ^C')
+        # Only now that the output is closed and the last deletes committed
+        if gResumeFrom is not None:
+            log.warning("Scan interrupted at tess_id %s, resume it with --resume-from %s", gResumeFrom, gResumeFrom)
     #except Exception as e:
-        print("Error => {0}".format(e))
+    #    print("Error => {0}".format(e))
 
 if __name__== "__main__":
     main()
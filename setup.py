@@ -17,6 +17,11 @@ DEPENDENCIES = [
     'tabulate',
 ]
 
+EXTRAS = {
+    'offline': ['numpy', 'scipy'],
+    'purge':   ['numpy'],
+}
+
 CLASSIFIERS  = [
     'Environment :: Console',
     'Intended Audience :: Science/Research',
@@ -60,6 +65,7 @@ setup(
     packages         = find_packages("src"),
     package_dir      = {"": "src"},
     install_requires = DEPENDENCIES,
+    extras_require   = EXTRAS,
     scripts          = SCRIPTS,
     package_data     = PACKAGE_DATA,
     data_files       = DATA_FILES,
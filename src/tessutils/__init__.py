@@ -12,8 +12,8 @@
 import os
 import sys
 
-# Access SQL scripts withing the package
-from pkg_resources import resource_filename
+# Access templates within the package
+import importlib.resources
 
 #--------------
 # local imports
@@ -33,8 +33,9 @@ DEFAULT_DBASE = '/var/dbase/tess.db'
 
 __version__ = get_versions()['version']
 
-# DATABASE RESOURCES
-CREATE_LOCATIONS_TEMPLATE = resource_filename(__name__, os.path.join('templates', 'location-create.j2'))
-PROBLEMATIC_LOCATIONS_TEMPLATE = resource_filename(__name__, os.path.join('templates', 'location-problematic.j2'))
+# TEMPLATE RESOURCES
+TEMPLATES_DIR = str(importlib.resources.files(__name__) / 'templates')
+CREATE_LOCATIONS_TEMPLATE = os.path.join(TEMPLATES_DIR, 'location-create.j2')
+PROBLEMATIC_LOCATIONS_TEMPLATE = os.path.join(TEMPLATES_DIR, 'location-problematic.j2')
 del get_versions
 
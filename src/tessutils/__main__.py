@@ -22,6 +22,12 @@ import importlib
 # -------------
 
 from . import __version__, DEFAULT_DBASE
+from .utils import pragma_setting, DEFAULT_ARRAYSIZE
+from .geocoding import DEFAULT_CACHE_TTL, DEFAULT_CACHE_SIZE, DEFAULT_GEOCODER_URL
+from .geocoding import DEFAULT_RATE, DEFAULT_WORKERS, DEFAULT_RETRIES, DEFAULT_TIMEOUT, DEFAULT_CLUSTER_RADIUS
+from .geocoding import DEFAULT_GAZETTEER_DISTANCE
+from .readings import DEFAULT_CHUNK_SIZE, DEFAULT_TOLERANCE
+from .filters import RULE_CODES, DEFAULT_FREQUENCY_RANGE, DEFAULT_AMBIENT_RANGE, DEFAULT_SKY_RANGE
 
 # ----------------
 # Module constants
@@ -96,6 +102,7 @@ def createParser():
     parser.add_argument('-x', '--exceptions', action='store_true',  help='print exception traceback when exiting.')
     parser.add_argument('-c', '--console', action='store_true',  help='log to console.')
     parser.add_argument('-l', '--log-file', type=str, default=None, action='store', metavar='<file path>', help='log to file')
+    parser.add_argument('-P', '--pragma', type=pragma_setting, default=[], action='append', metavar='<NAME=VALUE>', help='SQLite PRAGMA overriding the defaults, may be repeated')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-v', '--verbose', action='store_true', help='Verbose logging output.')
     group.add_argument('-q', '--quiet',   action='store_true', help='Quiet logging output.')
@@ -108,6 +115,8 @@ def createParser():
     subparser = parser.add_subparsers(dest='command')
 
     parser_image  = subparser.add_parser('location', help='image command')
+    parser_db  = subparser.add_parser('db', help='database commands')
+    parser_readings  = subparser.add_parser('readings', help='readings commands')
     
     # ---------------------------------------
     # Create second level parsers for 'location'
@@ -118,6 +127,78 @@ def createParser():
     locg.add_argument('-d', '--dbase', type=validfile, default=DEFAULT_DBASE, help='SQLite database full file path')
     locg.add_argument('-i', '--input-file', type=validfile, required=True, help='Input CSV file')
     locg.add_argument('-o', '--output-prefix', type=str, required=True, help='Output file prefix for the different files to generate')
+    locg.add_argument('--cache-dir', type=validdir, default=None, help='Geocoding cache directory (defaults to the output prefix directory)')
+    locg.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL, help='Geocoding cache entries time to live in days (default: %(default)s)')
+    locg.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, help='Geocoding cache maximum number of entries (default: %(default)s)')
+    locg.add_argument('--geocoder-url', type=str, default=DEFAULT_GEOCODER_URL, help='Nominatim server base URL (default: %(default)s)')
+    locg.add_argument('--rate', type=float, default=DEFAULT_RATE, help='Maximum geocoding requests per second (default: %(default)s)')
+    locg.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Maximum concurrent geocoding requests (default: %(default)s)')
+    locg.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help='Geocoding retries on failure (default: %(default)s)')
+    locg.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='Geocoding request timeout in seconds (default: %(default)s)')
+    locg.add_argument('--cluster-radius', type=float, default=DEFAULT_CLUSTER_RADIUS, help='Share one geocoding lookup among photometers within this radius in meters, 0 disables it (default: %(default)s)')
+    group = locg.add_mutually_exclusive_group()
+    group.add_argument('--no-cache', action='store_true', help='Do not use the geocoding cache')
+    group.add_argument('--offline', action='store_true', help='Serve reverse geocoding only from cache and report misses')
+    group.add_argument('--gazetteer', type=validfile, default=None, help='Reverse geocode offline with this GeoNames-style TSV places file')
+    locg.add_argument('--state-file', type=str, default=None, help='Incremental run state file (defaults to <output prefix>.state.json)')
+    locg.add_argument('--full', action='store_true', help='Geocode all photometers again, ignoring the site names found in previous runs')
+    locg.add_argument('--jsonl', action='store_true', help='Write geolocation results incrementally as JSON Lines')
+    locg.add_argument('--resume', action='store_true', help='Skip photometers already geolocated in an existing JSON Lines file (implies --jsonl)')
+    locg.add_argument('--gazetteer-distance', type=float, default=DEFAULT_GAZETTEER_DISTANCE, help='Maximum distance in meters to gazetteer places (default: %(default)s)')
+
+    loca = subparser.add_parser('apply',  help="Create locations and assign them directly in the database")
+    loca.add_argument('-d', '--dbase', type=validfile, default=DEFAULT_DBASE, help='SQLite database full file path')
+    loca.add_argument('-i', '--input-file', type=validfile, required=True, help='Input CSV file (i.e. the spreadsheet or a generated *_empty_sites_fixed.csv file)')
+    loca.add_argument('-n', '--dry-run', action='store_true', help='Print the plan without touching the database')
+
+    # ---------------------------------------
+    # Create second level parsers for 'db'
+    # ---------------------------------------
+
+    subparser = parser_db.add_subparsers(dest='subcommand')
+    dbe = subparser.add_parser('explain',  help="Check the query plans of all known queries and propose indexes")
+    dbe.add_argument('-d', '--dbase', type=validfile, default=DEFAULT_DBASE, help='SQLite database full file path')
+    dbe.add_argument('-n', '--name', type=str, default=None, help='Photometer name used as sample query parameter (default: first current photometer)')
+    dbe.add_argument('--create', action='store_true', help='Create the proposed indexes (the database is locked while building them)')
+    dbe.add_argument('--no-timing', dest='timing', action='store_false', help='Do not time the queries')
+
+    dbq = subparser.add_parser('query',  help="Stream the results of a read only SQL query")
+    dbq.add_argument('-d', '--dbase', type=validfile, default=DEFAULT_DBASE, help='SQLite database full file path')
+    group = dbq.add_mutually_exclusive_group(required=True)
+    group.add_argument('-s', '--sql', type=str, help='SQL query text')
+    group.add_argument('-f', '--file', type=validfile, help='File containing the SQL query')
+    dbq.add_argument('-F', '--format', choices=('csv', 'jsonl', 'table'), default='table', help='Output format (default: %(default)s)')
+    dbq.add_argument('-o', '--output', type=str, default=None, help='Output file (default: standard output)')
+    dbq.add_argument('--arraysize', type=int, default=DEFAULT_ARRAYSIZE, help='Rows fetched from SQLite at a time (default: %(default)s)')
+    dbq.add_argument('--no-pager', dest='pager', action='store_false', help='Do not page the output on a terminal')
+
+    # ---------------------------------------
+    # Create second level parsers for 'readings'
+    # ---------------------------------------
+
+    subparser = parser_readings.add_subparsers(dest='subcommand')
+    rdup = subparser.add_parser('duplicates',  help="Find readings repeating a sequence number within a time tolerance")
+    rdup.add_argument('-d', '--dbase', type=validfile, default=DEFAULT_DBASE, help='SQLite database full file path')
+    rdup.add_argument('-n', '--name', type=str, default=None, help='Only this photometer (default: all)')
+    rdup.add_argument('-t', '--tolerance', type=int, default=DEFAULT_TOLERANCE, help='Seconds within which a repeated sequence number is a duplicate (default: %(default)s)')
+    rdup.add_argument('--since', type=int, default=None, metavar='<YYYYMMDD>', help='Only readings from this date_id onwards')
+    rdup.add_argument('--until', type=int, default=None, metavar='<YYYYMMDD>', help='Only readings up to this date_id')
+    rdup.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Readings fetched per query (default: %(default)s)')
+    rdup.add_argument('-F', '--format', choices=('csv', 'jsonl', 'table'), default='table', help='Report format (default: %(default)s)')
+    rdup.add_argument('-o', '--output', type=str, default=None, help='Write a SQL script deleting the duplicates instead of reporting them (gzipped if ending in .gz)')
+
+    rfil = subparser.add_parser('filter',  help="Find readings failing any of several filter rules, in a single scan")
+    rfil.add_argument('-d', '--dbase', type=validfile, default=DEFAULT_DBASE, help='SQLite database full file path')
+    rfil.add_argument('-n', '--name', type=str, default=None, help='Only this photometer (default: all)')
+    rfil.add_argument('-r', '--rule', choices=RULE_CODES, default=[], action='append', help='Filter rule to check, may be repeated (default: all)')
+    rfil.add_argument('--frequency-range', type=float, nargs=2, default=DEFAULT_FREQUENCY_RANGE, metavar=('MIN', 'MAX'), help='Valid frequencies in Hz, MIN excluded (default: %(default)s)')
+    rfil.add_argument('--ambient-range', type=float, nargs=2, default=DEFAULT_AMBIENT_RANGE, metavar=('MIN', 'MAX'), help='Valid ambient temperatures in Celsius (default: %(default)s)')
+    rfil.add_argument('--sky-range', type=float, nargs=2, default=DEFAULT_SKY_RANGE, metavar=('MIN', 'MAX'), help='Valid sky temperatures in Celsius (default: %(default)s)')
+    rfil.add_argument('--since', type=int, default=None, metavar='<YYYYMMDD>', help='Only readings from this date_id onwards')
+    rfil.add_argument('--until', type=int, default=None, metavar='<YYYYMMDD>', help='Only readings up to this date_id')
+    rfil.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Readings fetched per query (default: %(default)s)')
+    rfil.add_argument('-F', '--format', choices=('csv', 'jsonl', 'table'), default='table', help='Report format (default: %(default)s)')
+    rfil.add_argument('-o', '--output', type=str, default=None, help='Write a SQL script deleting the readings instead of reporting them (gzipped if ending in .gz)')
   
     return parser
 
@@ -0,0 +1,227 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import re
+import sys
+import time
+import shutil
+import logging
+
+# -------------------
+# Third party imports
+# -------------------
+
+import tabulate
+
+#--------------
+# local imports
+# -------------
+
+from .utils import open_database, log_statistics, fetch_rows, paging, EXPORT_LINES
+from .queries import QUERIES
+
+# ----------------
+# Module constants
+# ----------------
+
+# Tables large enough for a full scan to be always worth reporting
+BIG_TABLES = ('tess_readings_t',)
+
+TABLE_ALIAS = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+AS)?(?:\s+(?!(?:ON|USING|WHERE|JOIN|SET|ORDER|GROUP|LIMIT|LEFT|INNER|CROSS|SELECT|VALUES)\b)(\w+))?', re.IGNORECASE)
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger('db')
+
+# -------------------------
+# Module auxiliar functions
+# -------------------------
+
+def table_aliases(connection, sql):
+    '''Maps table aliases (and the table names themselves) to table names, looking into views as well'''
+    aliases = dict()
+    for table, alias in TABLE_ALIAS.findall(sql):
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+        row = connection.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?", (table,)).fetchone()
+        if row:
+            aliases.update(table_aliases(connection, row[0]))
+    return aliases
+
+
+def sample_parameters(connection, query, name):
+    '''Registered parameters left to None are filled in with sample values from the database'''
+    samples = {'name': name}
+    return {key: samples.get(key) if value is None else value for key, value in query.params.items()}
+
+
+def query_plan(connection, query, params):
+    cursor = connection.execute("EXPLAIN QUERY PLAN " + query.sql, params)
+    return [row[-1] for row in cursor]
+
+
+def plan_problems(connection, plan, query):
+    '''
+    Flags full scans of big tables, full scans of tables with an index hint
+    unless done with a covering index, and temporary B-trees for ORDER BY
+    '''
+    aliases = table_aliases(connection, query.sql)
+    hinted = set(table for table, columns in query.indexes)
+    problems = list()
+    for detail in plan:
+        matchobj = re.match(r'SCAN (\w+)', detail)
+        if matchobj:
+            table = aliases.get(matchobj.group(1), matchobj.group(1))
+            if table in BIG_TABLES or (table in hinted and 'COVERING INDEX' not in detail):
+                problems.append(f"full scan of {table}")
+        if 'USE TEMP B-TREE FOR ORDER BY' in detail:
+            problems.append("temp B-tree for ORDER BY")
+    return problems
+
+
+def existing_indexes(connection, table):
+    '''Column tuples of all the indexes of a table, including the primary key'''
+    indexes = list()
+    for row in connection.execute(f"PRAGMA index_list({table})").fetchall():
+        columns = connection.execute(f"PRAGMA index_info({row[1]})").fetchall()
+        indexes.append(tuple(column[2] for column in columns))
+    return indexes
+
+
+def index_exists(connection, table, columns):
+    '''An index exists if any other index starts with the same columns'''
+    return any(index[:len(columns)] == tuple(columns) for index in existing_indexes(connection, table))
+
+
+def widest_indexes(missing):
+    '''Drops the proposed indexes whose columns are a prefix of another one on the same table'''
+    return [(table, columns) for table, columns in missing
+        if not any(other_table == table and len(other) > len(columns) and other[:len(columns)] == columns
+            for other_table, other in missing)]
+
+
+def create_index_sql(table, columns):
+    name = f"{table}_{'_'.join(columns)}_i"
+    return f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+
+
+def writes(connection, query, params):
+    '''Whether a statement modifies the database, i.e. its bytecode opens a table for writing'''
+    cursor = connection.execute("EXPLAIN " + query.sql, params)
+    return any(row[1] == 'OpenWrite' for row in cursor)
+
+
+def timing(connection, query, params):
+    '''Seconds to run a query and fetch all its rows. DML statements are not timed'''
+    if writes(connection, query, params):
+        return None
+    t0 = time.perf_counter()
+    cursor = connection.execute(query.sql, params)
+    while cursor.fetchmany(1000):
+        pass
+    return time.perf_counter() - t0
+
+
+def format_seconds(seconds):
+    return '-' if seconds is None else f"{seconds:.4f}"
+
+
+def analyze(connection, name, do_timing):
+    '''Plan problems, missing indexes and timing of every registered query'''
+    results = dict()
+    for qname, query in sorted(QUERIES.items()):
+        params = sample_parameters(connection, query, name)
+        plan = query_plan(connection, query, params)
+        log.debug("%s query plan: %s", qname, plan)
+        problems = plan_problems(connection, plan, query)
+        missing = [(table, columns) for table, columns in query.indexes if problems and not index_exists(connection, table, columns)]
+        seconds = timing(connection, query, params) if do_timing else None
+        results[qname] = (plan, problems, missing, seconds)
+    return results
+
+# ===================
+# Module entry points
+# ===================
+
+def explain(options):
+    log.info("QUERY PLANS & INDEX ADVISOR")
+    connection = open_database(options.dbase, read_only=not options.create, pragmas=options.pragma)
+    name = options.name
+    if name is None:
+        row = connection.execute("SELECT name FROM tess_t WHERE valid_state = 'Current' ORDER BY name LIMIT 1").fetchone()
+        name = row[0] if row else None
+    log.info("Using photometer %s as sample query parameter", name)
+    before = analyze(connection, name, options.timing)
+    # Ordered set of the missing indexes of all the queries
+    wanted = dict()
+    for qname, (plan, problems, missing, seconds) in before.items():
+        print(f"{qname}:")
+        for detail in plan:
+            print(f"    {detail}")
+        for table, columns in missing:
+            wanted[(table, columns)] = None
+    proposals = {key: create_index_sql(*key) for key in widest_indexes(wanted)}
+    if proposals:
+        print("\nProposed indexes:")
+        for sql in proposals.values():
+            print(f"    {sql};")
+    after = None
+    if options.create and proposals:
+        for sql in proposals.values():
+            log.info("Creating index: %s", sql)
+            t0 = time.perf_counter()
+            connection.execute(sql)
+            connection.commit()
+            log.info("Index created in %.1f seconds", time.perf_counter() - t0)
+        connection.execute("PRAGMA optimize")
+        after = analyze(connection, name, options.timing)
+    table = list()
+    for qname, (plan, problems, missing, seconds) in before.items():
+        row = [qname, "; ".join(problems) or "OK", format_seconds(seconds)]
+        if after is not None:
+            row.extend(["; ".join(after[qname][1]) or "OK", format_seconds(after[qname][3])])
+        table.append(row)
+    headers = ['Query', 'Plan problems', 'Seconds']
+    if after is not None:
+        headers.extend(['Plan problems after', 'Seconds after'])
+    print()
+    print(tabulate.tabulate(table, headers=headers, tablefmt='grid'))
+    log_statistics(log, connection)
+
+
+def query(options):
+    '''Streams the results of a read only SQL query'''
+    if options.file:
+        with open(options.file) as fd:
+            sql = fd.read()
+    else:
+        sql = options.sql
+    connection = open_database(options.dbase, read_only=True, pragmas=options.pragma)
+    cursor = connection.execute(sql)
+    if cursor.description is None:
+        raise ValueError("Not a query returning rows")
+    headers = [column[0] for column in cursor.description]
+    lines = EXPORT_LINES[options.format](fetch_rows(cursor, options.arraysize), headers)
+    t0 = time.perf_counter()
+    if options.output:
+        with open(options.output, 'w', newline='') as fd:
+            count = paging(lines, fd)
+    else:
+        page_size = None
+        if options.pager and sys.stdout.isatty() and sys.stdin.isatty():
+            page_size = max(1, shutil.get_terminal_size().lines - 1)
+        count = paging(lines, sys.stdout, page_size)
+    log.info("%d lines written in %.3f seconds", count, time.perf_counter() - t0)
+    cursor.close()
+    log_statistics(log, connection)
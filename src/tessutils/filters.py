@@ -0,0 +1,170 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import abc
+import logging
+import collections
+
+#--------------
+# local imports
+# -------------
+
+from .purge import HALF_WINDOW
+
+# ----------------
+# Module constants
+# ----------------
+
+# Reading columns, as given by the READINGS_CHUNK_TEMPERATURES query
+DATE_ID, TIME_ID, TESS_ID, SEQUENCE_NUMBER, FREQUENCY, MAGNITUDE, AMBIENT_TEMPERATURE, SKY_TEMPERATURE = range(8)
+
+# Plausible ranges, outside which readings are discarded
+DEFAULT_FREQUENCY_RANGE = (0.0, 100000.0)    # Hz, the lower bound excluded
+DEFAULT_AMBIENT_RANGE = (-50.0, 60.0)        # Celsius
+DEFAULT_SKY_RANGE = (-100.0, 60.0)           # Celsius
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger('filters')
+
+# -------
+# Classes
+# -------
+
+class Rule(abc.ABC):
+    '''
+    A predicate telling whether a reading must be discarded, tagged with a reason code.
+    It is called with a window of consecutive readings of a photometer in time order
+    and the index of the reading to check within it. The window holds up to
+    half_window readings before and after it, fewer at both ends of the series.
+    '''
+
+    code = None
+    half_window = 0
+
+    @abc.abstractmethod
+    def __call__(self, window, center):
+        pass
+
+
+class ZeroMagnitudeWindow(Rule):
+    '''
+    The reading is in the middle of a full window of zero magnitudes. Unlike the FIFO
+    of tess_purge_zeros.py, the fourth reading of a series is not also checked against
+    the windows growing from the start, so a short series may keep a few more readings.
+    '''
+
+    code = 'zero_magnitude'
+    half_window = HALF_WINDOW
+
+    def __call__(self, window, center):
+        if center < self.half_window or center + self.half_window >= len(window):
+            return False
+        return all(reading[MAGNITUDE] == 0 for reading in window[center - self.half_window:center + self.half_window + 1])
+
+
+class NonMonotonicSequence(Rule):
+    '''
+    The sequence number of the reading breaks the increasing sequence numbers of its
+    tess_id neighbours. A photometer reset, where the sequence number starts again
+    from zero, is not a break, nor is a repeated sequence number ('readings duplicates'
+    looks for those).
+    '''
+
+    code = 'sequence'
+    half_window = HALF_WINDOW
+
+    def __call__(self, window, center):
+        reading = window[center]
+        tess_id = reading[TESS_ID]
+        before = next((item for item in reversed(window[:center]) if item[TESS_ID] == tess_id), None)
+        after = next((item for item in window[center+1:] if item[TESS_ID] == tess_id), None)
+        if before is None or after is None or before[SEQUENCE_NUMBER] >= after[SEQUENCE_NUMBER]:
+            return False
+        return not (before[SEQUENCE_NUMBER] <= reading[SEQUENCE_NUMBER] <= after[SEQUENCE_NUMBER])
+
+
+class FrequencyRange(Rule):
+    '''Frequency out of range, zero or negative frequencies included'''
+
+    code = 'frequency'
+
+    def __init__(self, low=DEFAULT_FREQUENCY_RANGE[0], high=DEFAULT_FREQUENCY_RANGE[1]):
+        self.low = low
+        self.high = high
+
+    def __call__(self, window, center):
+        frequency = window[center][FREQUENCY]
+        return frequency is None or not (self.low < frequency <= self.high)
+
+
+class TemperatureRange(Rule):
+    '''Temperature out of range. Missing temperatures are not checked'''
+
+    def __init__(self, column, code, low, high):
+        self.column = column
+        self.code = code
+        self.low = low
+        self.high = high
+
+    def __call__(self, window, center):
+        temperature = window[center][self.column]
+        return temperature is not None and not (self.low <= temperature <= self.high)
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def make_rules(codes=None, frequency=DEFAULT_FREQUENCY_RANGE, ambient=DEFAULT_AMBIENT_RANGE, sky=DEFAULT_SKY_RANGE):
+    '''The rules with the given reason codes, all of them by default'''
+    rules = [
+        ZeroMagnitudeWindow(),
+        NonMonotonicSequence(),
+        FrequencyRange(*frequency),
+        TemperatureRange(AMBIENT_TEMPERATURE, 'ambient_temperature', *ambient),
+        TemperatureRange(SKY_TEMPERATURE, 'sky_temperature', *sky),
+    ]
+    if codes:
+        rules = [rule for rule in rules if rule.code in codes]
+    return rules
+
+
+RULE_CODES = tuple(rule.code for rule in make_rules())
+
+
+def tag_readings(readings, rules):
+    '''
+    Checks all the rules on the readings of a photometer in time order, in a single pass.
+    A sliding window as wide as the widest rule needs is kept, and every reading is
+    checked once it sits at its middle, or at the end of the series.
+    Yields (reading, reason codes) tuples for the readings failing any rule.
+    '''
+    half_window = max(rule.half_window for rule in rules)
+    window = collections.deque(maxlen=2*half_window + 1)
+    def check(center):
+        items = tuple(window)
+        codes = tuple(rule.code for rule in rules if rule(items, center))
+        if codes:
+            return items[center], codes
+        return None
+    for reading in readings:
+        window.append(reading)
+        if len(window) > half_window:
+            result = check(len(window) - half_window - 1)
+            if result:
+                yield result
+    # The last readings, with fewer readings after them
+    for center in range(max(len(window) - half_window, 0), len(window)):
+        result = check(center)
+        if result:
+            yield result
@@ -0,0 +1,420 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import math
+import time
+import json
+import random
+import sqlite3
+import logging
+import threading
+import collections
+import urllib.parse
+import concurrent.futures
+
+# -------------------
+# Third party imports
+# -------------------
+
+from geopy.geocoders import Nominatim
+from geopy.exc import GeocoderServiceError, GeocoderRateLimited
+
+# ----------------
+# Module constants
+# ----------------
+
+CACHE_FILE = 'geocoding-cache.db'
+DEFAULT_CACHE_TTL = 90        # days
+DEFAULT_CACHE_SIZE = 50000    # entries
+DEFAULT_CACHE_PRECISION = 5   # decimal places, roughly 1 meter
+
+USER_AGENT = "STARS4ALL project"
+DEFAULT_GEOCODER_URL = 'https://nominatim.openstreetmap.org'
+DEFAULT_RATE = 1.0      # requests per second, as per the Nominatim usage policy
+DEFAULT_WORKERS = 2     # concurrent requests in flight
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 2.0   # seconds, doubled on each retry
+DEFAULT_TIMEOUT = 10    # seconds per request
+
+EARTH_RADIUS = 6371008.8 # meters
+DEFAULT_CLUSTER_RADIUS = 0  # meters, 0 disables clustering
+
+DEFAULT_GAZETTEER_DISTANCE = 500 # meters
+GAZETTEER_NEIGHBOURS = 16
+GAZETTEER_INDEX = '.idx'
+# Address component for each GeoNames 'feature class.feature code' of interest
+GAZETTEER_KINDS = ('leisure', 'amenity', 'tourism', 'building', 'road', 'hamlet')
+GAZETTEER_FEATURES = {
+    'L.PRK': 'leisure',  'S.STDM': 'leisure', 'S.ZOO': 'leisure',  'S.GDN': 'leisure', 'S.RECG': 'leisure',
+    'S.SCH': 'amenity',  'S.SCHC': 'amenity', 'S.UNIV': 'amenity', 'S.HSP': 'amenity', 'S.OBS': 'amenity',
+    'S.OBSR': 'amenity', 'S.LIBR': 'amenity', 'S.PO': 'amenity',   'S.CH': 'amenity',  'S.STNM': 'amenity',
+    'S.HTL': 'tourism',  'S.HSTL': 'tourism', 'S.MTL': 'tourism',  'S.RSRT': 'tourism', 'S.CMP': 'tourism',
+    'S.MUS': 'tourism',  'S.BLDG': 'building', 'S.BLDO': 'building', 'S.HSE': 'building', 'S.FRM': 'building',
+    'R.RD': 'road',      'R.ST': 'road',      'R.TRL': 'road',
+    'P.PPL': 'hamlet',   'P.PPLL': 'hamlet',  'P.PPLX': 'hamlet',  'P.PPLF': 'hamlet',
+}
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger('location')
+
+# ------------------------
+# Module utility functions
+# ------------------------
+
+def distance(point1, point2):
+    '''Haversine distance in meters between two (latitude, longitude) points in degrees'''
+    lat1, lon1 = math.radians(point1[0]), math.radians(point1[1])
+    lat2, lon2 = math.radians(point2[0]), math.radians(point2[1])
+    h = math.sin((lat2-lat1)/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin((lon2-lon1)/2)**2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+def cluster(points, radius):
+    '''
+    Greedy leader clustering of (latitude, longitude) points over a grid of radius sized cells.
+    Each point joins the earliest previous leader within radius meters, looking only
+    at the 3x3 neighbouring cells, or becomes a new leader itself.
+    Returns the leader index of each point.
+    '''
+    cells = dict()
+    leaders = list()
+    for i, point in enumerate(points):
+        y = math.radians(point[0]) * EARTH_RADIUS
+        x = math.radians(point[1]) * EARTH_RADIUS * math.cos(math.radians(point[0]))
+        cx, cy = int(x // radius), int(y // radius)
+        candidates = [j for dx in (-1, 0, 1) for dy in (-1, 0, 1) for j in cells.get((cx+dx, cy+dy), ())
+            if distance(points[j], point) <= radius]
+        if candidates:
+            leaders.append(min(candidates))
+        else:
+            cells.setdefault((cx, cy), list()).append(i)
+            leaders.append(i)
+    return leaders
+
+# -------
+# Classes
+# -------
+
+class GeoCache:
+    '''
+    Persistent reverse geocoding cache in a local SQLite file.
+    Entries are keyed by rounded latitude/longitude and language and store the raw address dictionary.
+    Entries older than the TTL are never served and are evicted together with the least recently
+    used ones whenever the cache grows beyond its maximum size.
+    '''
+
+    def __init__(self, directory, ttl=DEFAULT_CACHE_TTL, size=DEFAULT_CACHE_SIZE, precision=DEFAULT_CACHE_PRECISION):
+        self.path = os.path.join(directory, CACHE_FILE)
+        self.ttl = ttl * 86400
+        self.size = size
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS reverse_t
+            (
+                latitude    TEXT,
+                longitude   TEXT,
+                language    TEXT,
+                address     TEXT,
+                created     REAL,
+                accessed    REAL,
+                PRIMARY KEY (latitude, longitude, language)
+            )
+            ''')
+        self.connection.commit()
+        log.info("Using geocoding cache %s", self.path)
+
+    def key(self, latitude, longitude, language):
+        return {
+            'latitude':  f"{float(latitude):.{self.precision}f}",
+            'longitude': f"{float(longitude):.{self.precision}f}",
+            'language':  language,
+        }
+
+    def get(self, latitude, longitude, language):
+        '''Returns a copy of the cached address dictionary or None'''
+        row = self.key(latitude, longitude, language)
+        row['expiry'] = time.time() - self.ttl
+        cursor = self.connection.execute(
+            '''
+            SELECT address FROM reverse_t
+            WHERE latitude = :latitude AND longitude = :longitude AND language = :language
+            AND created >= :expiry
+            ''', row)
+        result = cursor.fetchone()
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        row['accessed'] = time.time()
+        self.connection.execute(
+            '''
+            UPDATE reverse_t SET accessed = :accessed
+            WHERE latitude = :latitude AND longitude = :longitude AND language = :language
+            ''', row)
+        return json.loads(result[0])
+
+    def put(self, latitude, longitude, language, address):
+        row = self.key(latitude, longitude, language)
+        row['address'] = json.dumps(address)
+        row['created'] = row['accessed'] = time.time()
+        self.connection.execute(
+            '''
+            INSERT OR REPLACE INTO reverse_t (latitude, longitude, language, address, created, accessed)
+            VALUES (:latitude, :longitude, :language, :address, :created, :accessed)
+            ''', row)
+        # Lookups are slow, so commit each one to survive an interrupted run
+        self.connection.commit()
+
+    def evict(self):
+        '''Removes expired entries first and then the least recently used ones beyond the cache size'''
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM reverse_t WHERE created < ?", (time.time() - self.ttl,))
+        expired = cursor.rowcount
+        cursor.execute(
+            '''
+            DELETE FROM reverse_t WHERE rowid IN (
+                SELECT rowid FROM reverse_t ORDER BY accessed DESC LIMIT -1 OFFSET ?
+            )
+            ''', (self.size,))
+        log.info("Geocoding cache: %d hits, %d misses, %d expired & %d excess entries evicted",
+            self.hits, self.misses, expired, cursor.rowcount)
+
+    def close(self):
+        self.evict()
+        self.connection.commit()
+        self.connection.close()
+
+
+class NominatimBackend:
+    '''
+    Reverse geocoding backend using a Nominatim server.
+    Any object with a reverse(latitude, longitude, language) method returning
+    the address dictionary can be used as a backend.
+    '''
+
+    def __init__(self, url=DEFAULT_GEOCODER_URL, timeout=DEFAULT_TIMEOUT):
+        url = urllib.parse.urlsplit(url)
+        self.geolocator = Nominatim(user_agent=USER_AGENT, scheme=url.scheme, domain=url.netloc + url.path, timeout=timeout)
+
+    def reverse(self, latitude, longitude, language):
+        location = self.geolocator.reverse(f"{latitude}, {longitude}", language=language)
+        return location.raw['address'] if location else dict()
+
+
+class GazetteerBackend:
+    '''
+    Offline reverse geocoding backend using a local GeoNames-style TSV places file.
+    Places are indexed by a KD-tree over their unit sphere coordinates and the whole batch
+    of lookups is answered with a single vectorized query by reverse_many().
+    Parsed arrays are cached in a directory next to the places file and memory mapped
+    on subsequent runs. The language is ignored, as GeoNames names are in the local language.
+    Requires NumPy and SciPy.
+    '''
+
+    def __init__(self, path, max_distance=DEFAULT_GAZETTEER_DISTANCE):
+        try:
+            import numpy
+            from scipy.spatial import cKDTree
+        except ImportError:
+            raise ImportError("The offline gazetteer needs numpy & scipy. Install tessdb-utils[offline]")
+        self.np = numpy
+        # Chord length in the unit sphere for the given arc length
+        self.max_chord = 2 * math.sin(max_distance / (2 * EARTH_RADIUS))
+        directory = path + GAZETTEER_INDEX
+        if not os.path.isdir(directory) or os.path.getmtime(directory) < os.path.getmtime(path):
+            self.build(path, directory)
+        self.xyz = numpy.load(os.path.join(directory, 'xyz.npy'), mmap_mode='r')
+        self.kinds = numpy.load(os.path.join(directory, 'kinds.npy'), mmap_mode='r')
+        self.names = numpy.load(os.path.join(directory, 'names.npy'), mmap_mode='r')
+        self.offsets = numpy.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+        t0 = time.perf_counter()
+        self.tree = cKDTree(self.xyz, balanced_tree=False, compact_nodes=False)
+        log.info("Gazetteer KD-tree with %d places built in %.2f seconds", len(self.kinds), time.perf_counter() - t0)
+
+    def unit_vectors(self, latitudes, longitudes):
+        np = self.np
+        latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+        return np.column_stack((np.cos(latitudes) * np.cos(longitudes), np.cos(latitudes) * np.sin(longitudes), np.sin(latitudes)))
+
+    def build(self, path, directory):
+        '''Parses the places file, keeping only the features of interest, into compact arrays'''
+        np = self.np
+        log.info("Building gazetteer index %s", directory)
+        latitudes, longitudes, kinds, offsets = list(), list(), list(), [0]
+        names = bytearray()
+        with open(path, encoding='utf-8') as fd:
+            for line in fd:
+                fields = line.rstrip('\n').split('\t')
+                kind = GAZETTEER_FEATURES.get(f"{fields[6]}.{fields[7]}")
+                if kind is None:
+                    continue
+                latitudes.append(float(fields[4]))
+                longitudes.append(float(fields[5]))
+                kinds.append(GAZETTEER_KINDS.index(kind))
+                names += fields[1].encode('utf-8')
+                offsets.append(len(names))
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'xyz.npy'), self.unit_vectors(np.array(latitudes), np.array(longitudes)))
+        np.save(os.path.join(directory, 'kinds.npy'), np.array(kinds, dtype=np.int8))
+        np.save(os.path.join(directory, 'names.npy'), np.frombuffer(bytes(names), dtype=np.uint8))
+        np.save(os.path.join(directory, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+        os.utime(directory)
+
+    def name(self, i):
+        return self.names[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf-8')
+
+    def reverse_many(self, points, language):
+        '''
+        Returns an address dictionary for each (latitude, longitude) point, holding
+        the nearest place of each kind within the maximum distance.
+        '''
+        if not points:
+            return list()
+        points = self.np.array(points, dtype=float)
+        k = min(GAZETTEER_NEIGHBOURS, len(self.kinds))
+        distances, indices = self.tree.query(self.unit_vectors(points[:, 0], points[:, 1]), k=k, distance_upper_bound=self.max_chord)
+        distances, indices = distances.reshape(len(points), k), indices.reshape(len(points), k)
+        addresses = list()
+        for row in indices:
+            address = dict()
+            # Neighbours come sorted by distance, missing ones have an index past the end
+            for i in row[row < len(self.kinds)]:
+                address.setdefault(GAZETTEER_KINDS[self.kinds[i]], self.name(i))
+            addresses.append(address)
+        return addresses
+
+    def reverse(self, latitude, longitude, language):
+        return self.reverse_many([(float(latitude), float(longitude))], language)[0]
+
+
+class TokenBucket:
+    '''Thread safe token bucket limiting the request rate with a given burst capacity'''
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class Scheduler:
+    '''
+    Runs reverse geocoding requests in a thread pool, honouring the provider rate limit
+    through a token bucket and retrying failed requests with exponential backoff and jitter.
+    '''
+
+    def __init__(self, backend, rate=DEFAULT_RATE, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.backend = backend
+        self.bucket = TokenBucket(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.inflight = 2 * workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='geocoder')
+
+    def reverse(self, latitude, longitude, language):
+        '''Returns the address dictionary or None if all attempts failed'''
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                return self.backend.reverse(latitude, longitude, language)
+            except GeocoderRateLimited as e:
+                delay = e.retry_after or self.backoff * 2**attempt
+                log.warn("rate limited by geocoder on (%s, %s), attempt %d", latitude, longitude, attempt+1)
+            except GeocoderServiceError as e:
+                delay = self.backoff * 2**attempt
+                log.warn("geocoder error on (%s, %s), attempt %d: %s", latitude, longitude, attempt+1, e)
+            if attempt < self.retries:
+                time.sleep(delay * random.uniform(0.5, 1.5))
+        log.error("giving up reverse geocoding (%s, %s) after %d attempts", latitude, longitude, self.retries+1)
+        return None
+
+    def submit(self, latitude, longitude, language):
+        return self.executor.submit(self.reverse, latitude, longitude, language)
+
+    @staticmethod
+    def completed(address):
+        '''An already resolved request, i.e. served from cache'''
+        future = concurrent.futures.Future()
+        future.set_result(address)
+        return future
+
+    def map(self, iterable, request):
+        '''
+        Yields (item, address) tuples in the same order as the input items.
+        The request function maps each item to a future, usually returned by submit().
+        No more than the in-flight limit requests are pending at any time.
+        '''
+        pending = collections.deque()
+        for item in iterable:
+            pending.append((item, request(item)))
+            while pending and (len(pending) >= self.inflight or pending[0][1].done()):
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class BatchScheduler(Scheduler):
+    '''
+    Scheduler for local backends with a reverse_many() method.
+    Requests are collected while mapping and resolved with a single vectorized backend call.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.pending = list()
+
+    def submit(self, latitude, longitude, language):
+        future = concurrent.futures.Future()
+        self.pending.append((future, (float(latitude), float(longitude)), language))
+        return future
+
+    def flush(self):
+        for language in set(language for future, point, language in self.pending):
+            batch = [(future, point) for future, point, lang in self.pending if lang == language]
+            addresses = self.backend.reverse_many([point for future, point in batch], language)
+            for (future, point), address in zip(batch, addresses):
+                future.set_result(address)
+        self.pending = list()
+
+    def map(self, iterable, request):
+        pending = [(item, request(item)) for item in iterable]
+        self.flush()
+        for item, future in pending:
+            yield item, future.result()
+
+    def close(self):
+        pass
@@ -13,23 +13,20 @@ import os
 import csv
 import math
 import json
+import hashlib
+import collections
 import logging
 import traceback
 
-# -------------------
-# Third party imports
-# -------------------
-
-import jinja2
-from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
-
 #--------------
 # local imports
 # -------------
 
 from . import CREATE_LOCATIONS_TEMPLATE, PROBLEMATIC_LOCATIONS_TEMPLATE
-from .utils import open_database
+from .utils import open_database, log_statistics, render
+from .registry import registry
+from .queries import LOCATION_EXISTS, LOCATION_CREATE, PHOTOMETER_ASSIGN, PHOTOMETER_ENABLE
+from .geocoding import GeoCache, NominatimBackend, GazetteerBackend, Scheduler, BatchScheduler, cluster
 
 # ----------------
 # Module constants
@@ -40,6 +37,7 @@ LONGITUDE = 'Longitud'
 LATITUDE = 'Latitud'
 NAME = 'stars'
 SITE_NAME = 'Nombre lugar'
+LANGUAGE = 'en'
 
 # -----------------------
 # Module global variables
@@ -52,30 +50,19 @@ log = logging.getLogger('location')
 # -------------------------
 
 def deployment_list(path, headers):
+    '''Streams the spreadsheet rows one at a time'''
     with open(path, newline='') as csvfile:
         reader = csv.DictReader(csvfile, fieldnames=headers, delimiter=',')
-        return [row for row in reader]
+        yield from reader
     
 
-def database_list(connection):
-    cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT DISTINCT name 
-        FROM tess_v 
-        WHERE valid_state = 'Current'
-        AND name LIKE 'stars%'
-        AND location = 'Unknown'
-        ''')
-    return [row[0] for row in cursor]
-
-from functools import partial
-
-
-def filter_by_name(row, names_iterable):
-    if row[NAME] in names_iterable:
-        return True
-    return False
+def database_index(connection):
+    '''
+    Name-keyed index of the registered photometers still without location.
+    It is built once per run so that matching each spreadsheet row is a dictionary lookup.
+    '''
+    return registry(connection).unknown_location()
+
 
 def valid_coordinates(row):
     '''
@@ -94,28 +81,6 @@ def valid_coordinates(row):
     return flag
 
 
-def invalid_coordinates(row):
-    return not valid_coordinates(row)
-
-
-def check_disjoint_sets(valid_list, invalid_list):
-    '''
-    Check if a given photometer is at the same time in the valid list with valid coordinates
-    and the invalid list with invalid coordinates
-    '''
-    valid_set = set([row[NAME] for row in valid_list])
-    invalid_set = set([row[NAME] for row in invalid_list])
-    problem_set = valid_set.intersection(invalid_set)
-    if (len(problem_set)):
-        log.info("The following set of photometers have lines in the spreadhseet with both valid and invalid coordinates at the same time:")
-        log.info("%r", problem_set )
-    else:
-        log.info("Check photometer complete")
-    return valid_set - problem_set
-    
-def check_not_empty_sitenames(row):
-    return not (row[SITE_NAME] == '' or  row[SITE_NAME].isspace())
-
 def check_empty_sitenames(row):
     return (row[SITE_NAME] == '' or  row[SITE_NAME].isspace())
 
@@ -129,96 +94,309 @@ def fieldnames(path, separator=","):
     log.info("headers = %s",headers)
     return headers
 
-def photometer_filtering(dbase, input_file, headers):
+def hash_rows(deployed_iterable, index, hashes):
+    '''Passes rows through while updating a content hash of each registered photometer rows'''
+    for row in deployed_iterable:
+        if row[NAME] in index:
+            if row[NAME] not in hashes:
+                hashes[row[NAME]] = hashlib.sha256()
+            hashes[row[NAME]].update(json.dumps(list(row.values())).encode('utf-8'))
+        yield row
+
+
+def collect_names(deployed_iterable, names):
+    '''Passes rows through while collecting their photometer names'''
+    for row in deployed_iterable:
+        names.add(row[NAME])
+        yield row
+
+
+def load_state(path):
+    '''Photometers done in previous runs, with their rows hash and geocoded site names'''
+    if not os.path.exists(path):
+        return dict()
+    with open(path) as fd:
+        state = json.load(fd)
+    # State files from older versions did not keep the site names and are ignored
+    return state.get('photometers', dict())
+
+
+def save_state(path, photometers):
+    '''Atomically saves the rows hash and the geocoded site names of the photometers done'''
+    with open(path + ".tmp", "w") as fd:
+        json.dump({'photometers': photometers}, fd, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def unchanged_photometers(index, hashes, state):
+    '''
+    Registered photometers still without location whose spreadsheet rows are the same
+    as when they were done in a previous run, so their stored site names can be reused
+    '''
+    return set(name for name in index
+        if name in state and name in hashes and state[name]['hash'] == hashes[name].hexdigest())
+
+
+def site_key(row):
+    return f"{row[LATITUDE]},{row[LONGITUDE]}"
+
+
+def conflicting_photometers(deployed_iterable, index):
     '''
-    Analyzes all photometers from the excel and divides them into two categories:
-    - the ones with valid latitud and Longitud coordinates
-    - The rest
+    First pass over the spreadsheet.
+    Returns the set of registered photometers having lines with both valid and invalid coordinates.
+    Only photometer names are kept in memory.
     '''
-    connection = open_database(dbase)
-    deployed_list = deployment_list(input_file, headers)
-    registered_list = database_list(connection)
-    matching_list = list(filter(partial(filter_by_name, names_iterable=registered_list), deployed_list))
-    log.info("Matched %d photometers", len(matching_list))
-    valid_coord_list = list(filter(valid_coordinates, matching_list))
-    invalid_coord_list = list(filter(invalid_coordinates, matching_list))
-    log.info("%d photometers with invalid coordinates", len(valid_coord_list))
-    purged_set = check_disjoint_sets(valid_coord_list, invalid_coord_list)
-    valid_coord_list = list(filter(partial(filter_by_name, names_iterable=purged_set), valid_coord_list))
-    log.info("%d photometers with valid coordinates after the problematic ones have been removed", len(valid_coord_list))
-    empty_sites_list = list(filter(check_empty_sitenames,valid_coord_list))
-    log.info("%d photometers with empty site names", len(empty_sites_list))
-    final_list = list(filter(check_not_empty_sitenames,valid_coord_list))
-    final_list = list(map(remove_embedded_newlines_in_sitenames, final_list))
-    log.info("%d photometers for final scrpt", len(final_list))
-    return final_list, empty_sites_list, invalid_coord_list
-
-def render(template_path, context):
-    if not os.path.exists(template_path):
-        raise IOError("No Jinja2 template file found at {0}. Exiting ...".format(template_path))
-    path, filename = os.path.split(template_path)
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path or './')
-    ).get_template(filename).render(context)
-
-def generate_csv(path, iterable, fieldnames):
-    with open(path, "w") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in iterable:
-            writer.writerow(row)
-   
+    valid_names = set()
+    invalid_names = set()
+    for row in deployed_iterable:
+        if row[NAME] not in index:
+            continue
+        if valid_coordinates(row):
+            valid_names.add(row[NAME])
+        else:
+            invalid_names.add(row[NAME])
+    conflict = valid_names & invalid_names
+    if conflict:
+        log.info("The following set of photometers have lines in the spreadhseet with both valid and invalid coordinates at the same time:")
+        log.info("%r", conflict)
+    else:
+        log.info("Check photometer complete")
+    return conflict
+
+
+def classify(deployed_iterable, index, conflict, on_invalid, on_empty, counters):
+    '''
+    Second pass over the spreadsheet. Each row belonging to a registered photometer is dispatched exactly once:
+    - rows with invalid coordinates are sent to the on_invalid sink
+    - rows with valid coordinates but an empty site name are sent to the on_empty sink
+    - rows with valid coordinates and a site name are cleaned and yielded
+    Rows from conflicting photometers with valid coordinates are dropped.
+    The counters dictionary is updated as rows flow through.
+    '''
+    for row in deployed_iterable:
+        if row[NAME] not in index:
+            continue
+        counters['matched'] += 1
+        if not valid_coordinates(row):
+            counters['invalid'] += 1
+            on_invalid(row)
+        elif row[NAME] in conflict:
+            counters['conflict'] += 1
+        elif check_empty_sitenames(row):
+            counters['empty'] += 1
+            on_empty(row)
+        else:
+            counters['valid'] += 1
+            yield remove_embedded_newlines_in_sitenames(row)
+
+
+def log_counters(counters):
+    log.info("Matched %d photometers", counters['matched'])
+    log.info("%d photometers with invalid coordinates", counters['invalid'])
+    log.info("%d photometers with empty site names", counters['empty'])
+    log.info("%d photometers for final scrpt", counters['valid'])
+
+
+def csv_writer(fd, fieldnames):
+    writer = csv.DictWriter(fd, fieldnames=fieldnames)
+    writer.writeheader()
+    return writer
+
 def generate_script(path, valid_coords_iterable, dbpath):
     context = dict()
     context['locations'] = valid_coords_iterable
     context['database'] = dbpath
-    contents = render(CREATE_LOCATIONS_TEMPLATE, context)
     with open(path, "w") as script:
-        script.write(contents)
+        render(CREATE_LOCATIONS_TEMPLATE, context, script)
     
 def generate_json(path, iterable):
     with open(path, "w") as fd:
         json.dump(iterable, fd, indent=2)
 
 
-def geolocate(iterable):
-    addresses = list()
-    fixed = list()
-    not_fixed = list()
-    geolocator = Nominatim(user_agent="STARS4ALL project")
-    geocode = RateLimiter(geolocator.geocode, min_delay_seconds=2)
-    for row in iterable:
-        location = geolocator.reverse(f"{row[LATITUDE]}, {row[LONGITUDE]}", language="en")
-        address = location.raw['address']
+def jsonl_writer(fd):
+    '''Returns a sink writing each record as a JSON line, flushed so that it survives a crash'''
+    def write(record):
+        fd.write(json.dumps(record) + "\n")
+        fd.flush()
+    return write
+
+
+def read_jsonl(path):
+    '''Yields the records of a JSON Lines file, skipping any line truncated by an interrupted run'''
+    with open(path) as fd:
+        for line in fd:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                log.warn("skipping truncated line in %s", path)
+
+
+def geolocation_key(photometer, latitude, longitude):
+    return (photometer, latitude, longitude)
+
+
+def resolved_addresses(path):
+    '''
+    Addresses already resolved in a previous geolocation JSON Lines file,
+    keyed by photometer name and coordinates. Later records win.
+    '''
+    resolved = dict()
+    for address in read_jsonl(path):
+        info = address['stars4all']
+        key = geolocation_key(info['photometer'], info['latitude'], info['longitude'])
+        if info['location_name'] is not None:
+            resolved[key] = address
+        else:
+            resolved.pop(key, None)
+    log.info("%d photometers already geolocated in %s", len(resolved), path)
+    return resolved
+
+
+def assign_place_name(row, address):
+    '''
+    Picks the site name from the address components in order of preference
+    and records the choice in the address 'stars4all' block.
+    Returns True if a place name was found.
+    '''
+    for location_type in ('leisure', 'amenity', 'tourism', 'building', 'road', 'hamlet',):
+        try:
+            row[SITE_NAME] = address[location_type]
+        except KeyError:
+            continue   
+        else:
+            if location_type == 'road' and address.get('house_number'):
+                row[SITE_NAME] = address[location_type] + ", " + address['house_number']
+                address['stars4all']['location_type'] = 'road + house_number'
+            else:
+                address['stars4all']['location_type'] = location_type
+            address['stars4all']['location_name'] = row[SITE_NAME]
+            log.debug("assigning %s -> '%s'  as place name to %s",location_type, address[location_type], row[NAME])
+            return True
+    address['stars4all']['location_type'] = None
+    address['stars4all']['location_name'] = None
+    log.warn("still without a valid place name to %s",row[NAME])
+    return False
+
+
+def geolocate(iterable, scheduler, cache=None, offline=False, radius=0):
+    '''
+    Reverse geocodes the rows with empty site names through the scheduler.
+    Yields (row, address) tuples in input order as soon as each lookup is done.
+    The address 'stars4all' block has a None location_name when no place name could be found.
+    Lookups are served from the cache when possible. In offline mode, cache misses are
+    reported and yield an empty address.
+    With a non zero radius (meters), nearby photometers are clustered and only the cluster
+    leader is looked up, sharing its result with the rest of the cluster.
+    '''
+    rows = list(iterable)
+    if radius > 0:
+        leaders = cluster([(float(row[LATITUDE]), float(row[LONGITUDE])) for row in rows], radius)
+        sizes = collections.Counter(leaders)
+        log.info("%d photometers with empty site names grouped in %d clusters", len(rows), len(sizes))
+    else:
+        leaders = list(range(len(rows)))
+    futures = dict()
+
+    def request(job):
+        i, row, cached = job
+        if cached is not None:
+            future = scheduler.completed(cached)
+            if leaders[i] == i:
+                # Leaders come first, so that their followers share the cached lookup
+                futures[i] = future
+            return future
+        if leaders[i] not in futures:
+            if offline:
+                futures[leaders[i]] = scheduler.completed(None)
+            else:
+                futures[leaders[i]] = scheduler.submit(rows[leaders[i]][LATITUDE], rows[leaders[i]][LONGITUDE], LANGUAGE)
+        return futures[leaders[i]]
+
+    jobs = ((i, row, cache.get(row[LATITUDE], row[LONGITUDE], LANGUAGE) if cache else None) for i, row in enumerate(rows))
+    misses = 0
+    for (i, row, cached), address in scheduler.map(jobs, request):
+        if cached is None:
+            if offline and address is None:
+                misses += 1
+                log.warn("no cached place for %s (%s, %s) in offline mode", row[NAME], row[LATITUDE], row[LONGITUDE])
+            elif address is not None and cache and leaders[i] == i:
+                cache.put(row[LATITUDE], row[LONGITUDE], LANGUAGE, address)
+        # Copied as the same lookup result may be shared by a cluster
+        address = dict() if address is None else dict(address)
         address['stars4all'] = dict()
         address['stars4all']['photometer'] = row[NAME]
         address['stars4all']['longitude'] = row[LONGITUDE]
         address['stars4all']['latitude'] = row[LATITUDE]
-        addresses.append(address)
-        found = False
-        for location_type in ('leisure', 'amenity', 'tourism', 'building', 'road', 'hamlet',):
-            try:
-                row[SITE_NAME] = address[location_type]
-            except KeyError:
-                continue   
-            else:
-                found = True
-                if location_type == 'road' and address.get('house_number'):
-                    row[SITE_NAME] = address[location_type] + ", " + address['house_number']
-                    address['stars4all']['location_type'] = 'road + house_number'
-                else:
-                    address['stars4all']['location_type'] = location_type
-                address['stars4all']['location_name'] = row[SITE_NAME]
-                break
-        if found:
-            fixed.append(row)
-            log.debug("assigning %s -> '%s'  as place name to %s",location_type, address[location_type], row[NAME])
+        if radius > 0:
+            address['stars4all']['cluster'] = rows[leaders[i]][NAME]
+            address['stars4all']['cluster_size'] = sizes[leaders[i]]
+        assign_place_name(row, address)
+        yield row, address
+    if offline:
+        log.info("%d cache misses in offline mode", misses)
+
+
+def as_float(value, default=0.0):
+    '''Same behaviour as the Jinja2 float filter used in the location script template'''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def location_plan(rows):
+    '''
+    Turns the valid spreadsheet rows into the parameter sets for the database statements,
+    mirroring the commands in the location script template
+    '''
+    plan = list()
+    for row in rows:
+        step = {
+            'name':         row[NAME],
+            'site':         row[SITE_NAME],
+            'longitude':    float(row[LONGITUDE]),
+            'latitude':     float(row[LATITUDE]),
+            'elevation':    as_float(row.get('MSNM')),
+        }
+        for column, key in (('contact_name', 'owner'), ('contact_email', 'email'), ('organization', 'org')):
+            if key in row:
+                step[column] = row[key]
+        plan.append(step)
+    return plan
+
+
+def print_plan(connection, plan):
+    cursor = connection.cursor()
+    for step in plan:
+        cursor.execute(LOCATION_EXISTS, step)
+        exists = cursor.fetchone()[0] > 0
+        print(f"### {step['name']} ###")
+        if exists:
+            print(f"location '{step['site']}' already exists")
         else:
-            address['stars4all']['location_type'] = None
-            address['stars4all']['location_name'] = None
-            not_fixed.append(row)
-            log.warn("still without a valid place name to %s",row[NAME])
-    return fixed, not_fixed, addresses
+            print(f"create location '{step['site']}' longitude={step['longitude']} latitude={step['latitude']} elevation={step['elevation']}")
+        for column in ('contact_name', 'contact_email', 'organization'):
+            if column in step:
+                print(f"update location '{step['site']}' {column}='{step[column]}'")
+        print(f"assign {step['name']} to location '{step['site']}' and enable it")
+
+
+def apply_plan(connection, plan):
+    '''Applies the whole location plan in a single transaction'''
+    with connection:
+        cursor = connection.cursor()
+        cursor.executemany(LOCATION_CREATE, plan)
+        log.info("%d new locations created", cursor.rowcount)
+        for column in ('contact_name', 'contact_email', 'organization'):
+            cursor.executemany(
+                f"UPDATE location_t SET {column} = :{column} WHERE site = :site",
+                [step for step in plan if column in step])
+        cursor.executemany(PHOTOMETER_ASSIGN, plan)
+        log.info("%d photometers assigned to their locations", cursor.rowcount)
+        cursor.executemany(PHOTOMETER_ENABLE, plan)
+        log.info("%d photometers enabled", cursor.rowcount)
 
 
 # ===================
@@ -228,29 +406,121 @@ def geolocate(iterable):
 def generate(options):
     log.info("LOCATIONS SCRIPT GENERATION")
     headers = fieldnames(options.input_file)
-    valid_coords, empty_sites, invalid_coords = photometer_filtering(options.dbase, options.input_file, headers)
-    
-    empty_sites_fixed, empty_sites_not_fixed, addresses_json = geolocate(empty_sites)
-
-    path =  options.output_prefix + "_empty_sites_fixed.csv"
-    generate_csv(path, empty_sites_fixed, headers)
-    log.info("generated CSV file -> %s", path)
-
-    path =  options.output_prefix + "_empty_sites_not_fixed.csv"
-    generate_csv(path, empty_sites_not_fixed, headers)
-    log.info("generated CSV file -> %s", path)
-    
-    path =  options.output_prefix + "_empty_sites_geoloc.json"
-    generate_json(path, addresses_json)
-    log.info("generated CSV file -> %s", path)
+    connection = open_database(options.dbase, read_only=True, pragmas=options.pragma)
+    index = database_index(connection)
+    hashes = dict()
+    conflict = conflicting_photometers(hash_rows(deployment_list(options.input_file, headers), index, hashes), index)
+    state_path = options.state_file or options.output_prefix + ".state.json"
+    state = dict() if options.full else load_state(state_path)
+    unchanged = unchanged_photometers(index, hashes, state)
+    if unchanged:
+        log.info("%d photometers unchanged since the last run, reusing their site names: %s",
+            len(unchanged), ", ".join(sorted(unchanged)))
+    counters = collections.Counter()
+    geocoder_queue = list()
+    # Photometers whose rows reached the script or the fixed sites file, those with rows left behind
+    # and the site names found for their empty site rows
+    done = set()
+    failed = set(conflict)
+    sites = collections.defaultdict(dict)
+
+    def stored_site(row):
+        if row[NAME] not in unchanged:
+            return None
+        return state[row[NAME]]['sites'].get(site_key(row))
+
+    invalid_path =  options.output_prefix + "_invalid_coords.csv"
+    script_path = options.output_prefix + ".sh"
+    with open(invalid_path, "w") as invalid_fd:
+        invalid_writer = csv_writer(invalid_fd, headers)
+        def on_invalid(row):
+            failed.add(row[NAME])
+            invalid_writer.writerow(row)
+        valid_coords = classify(deployment_list(options.input_file, headers), index, conflict, 
+            on_invalid, geocoder_queue.append, counters)
+        generate_script(script_path, collect_names(valid_coords, done), options.dbase)
+    log_counters(counters)
+    log.info("generated CSV file -> %s", invalid_path)
+    log.info("generated script file with valid coords -> %s", script_path)
+
+    cache = None
+    if options.gazetteer:
+        # Local lookups are cheaper than the cache and must not be mixed with Nominatim results
+        backend = GazetteerBackend(options.gazetteer, max_distance=options.gazetteer_distance)
+        scheduler = BatchScheduler(backend)
+    else:
+        if not options.no_cache:
+            directory = options.cache_dir or os.path.dirname(options.output_prefix) or '.'
+            cache = GeoCache(directory, ttl=options.cache_ttl, size=options.cache_size)
+        elif options.offline:
+            raise ValueError("--offline mode needs the geocoding cache")
+        backend = NominatimBackend(options.geocoder_url, timeout=options.timeout)
+        scheduler = Scheduler(backend, rate=options.rate, workers=options.workers, retries=options.retries)
+    resolved = dict()
+    if options.jsonl or options.resume:
+        json_path = options.output_prefix + "_empty_sites_geoloc.jsonl"
+        if options.resume and os.path.exists(json_path):
+            resolved = resolved_addresses(json_path)
+        json_fd = open(json_path, "a" if options.resume else "w")
+        record = jsonl_writer(json_fd)
+    else:
+        json_path = options.output_prefix + "_empty_sites_geoloc.json"
+        addresses_json = list()
+        record = addresses_json.append
+    pending = [row for row in geocoder_queue if stored_site(row) is None
+        and geolocation_key(row[NAME], row[LATITUDE], row[LONGITUDE]) not in resolved]
+    results = geolocate(pending, scheduler, cache, options.offline, options.cluster_radius)
+    fixed_path =  options.output_prefix + "_empty_sites_fixed.csv"
+    not_fixed_path =  options.output_prefix + "_empty_sites_not_fixed.csv"
+    with open(fixed_path, "w") as fixed_fd, open(not_fixed_path, "w") as not_fixed_fd:
+        fixed_writer = csv_writer(fixed_fd, headers)
+        not_fixed_writer = csv_writer(not_fixed_fd, headers)
+        for row in geocoder_queue:
+            site = stored_site(row)
+            if site is None:
+                address = resolved.get(geolocation_key(row[NAME], row[LATITUDE], row[LONGITUDE]))
+                if address is None:
+                    # pending rows come out of geolocate in the same order
+                    row, address = next(results)
+                    record(address)
+                site = address['stars4all']['location_name']
+            if site is not None:
+                row[SITE_NAME] = site
+                sites[row[NAME]][site_key(row)] = site
+                done.add(row[NAME])
+                fixed_writer.writerow(row)
+            else:
+                failed.add(row[NAME])
+                not_fixed_writer.writerow(row)
+    scheduler.close()
+    if cache:
+        cache.close()
+    log.info("generated CSV file -> %s", fixed_path)
+    log.info("generated CSV file -> %s", not_fixed_path)
+    if options.jsonl or options.resume:
+        json_fd.close()
+    else:
+        generate_json(json_path, addresses_json)
+    log.info("generated JSON file -> %s", json_path)
+    photometers = {name: {'hash': hashes[name].hexdigest(), 'sites': sites[name]}
+        for name in done - failed if name in hashes}
+    save_state(state_path, photometers)
+    log.info("saved state file -> %s, %d photometers left to retry", state_path, len(set(hashes) - set(photometers)))
+    log_statistics(log, connection)
 
-    path =  options.output_prefix + "_invalid_coords.csv"
-    generate_csv(path, invalid_coords, headers)
-    log.info("generated CSV file -> %s", path)
 
-    path = options.output_prefix + ".sh"
-    generate_script(path, valid_coords, options.dbase)
-    log.info("generated script file with valid coords -> %s", path)
-    
-    
-   
\ No newline at end of file
+def apply(options):
+    log.info("LOCATIONS DIRECT APPLY")
+    headers = fieldnames(options.input_file)
+    connection = open_database(options.dbase, read_only=options.dry_run, pragmas=options.pragma)
+    index = database_index(connection)
+    conflict = conflicting_photometers(deployment_list(options.input_file, headers), index)
+    counters = collections.Counter()
+    ignore = lambda row: None
+    plan = location_plan(classify(deployment_list(options.input_file, headers), index, conflict, ignore, ignore, counters))
+    log_counters(counters)
+    if options.dry_run:
+        print_plan(connection, plan)
+    else:
+        apply_plan(connection, plan)
+    log_statistics(log, connection)
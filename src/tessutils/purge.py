@@ -0,0 +1,357 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import gzip
+import json
+import time
+import logging
+import collections
+
+# -------------------
+# Third party imports
+# -------------------
+
+import tabulate
+
+#--------------
+# local imports
+# -------------
+
+from .queries import PURGE_VICTIMS_TABLE, PURGE_WINDOWS_ALL, PURGE_WINDOWS_BY_NAME, PURGE_VICTIMS, PURGE_DELETE
+from .readings import MIN_KEY, MAX_KEY
+
+# ----------------
+# Module constants
+# ----------------
+
+# Readings before and after the one checked in the sliding window
+HALF_WINDOW = 3
+
+# Readings deleted per transaction, short enough not to stall the tessdb writer
+DEFAULT_BATCH_SIZE = 10000
+
+# Sampled reading traces: the first ones of every photometer and one out of every so many afterwards
+DEFAULT_TRACE_FIRST = 10
+DEFAULT_TRACE_EVERY = 100000
+
+TELEMETRY_COUNTERS = ('scanned', 'kept', 'discarded', 'flushed')
+
+# Read only connections need this to create the temporary victims table
+WINDOW_ENGINE_PRAGMAS = {'query_only': 'OFF'}
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger('purge')
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def window_victims(connection, names=None, since=None, until=None):
+    '''
+    Zero magnitude detection with SQL window functions. The readings to delete are
+    materialized in the temp.purge_victims_t table, either for the whole database
+    in a single statement or for the given photometer names only.
+    Returns the number of victims found.
+    '''
+    connection.execute(PURGE_VICTIMS_TABLE)
+    connection.execute("DELETE FROM temp.purge_victims_t")
+    params = {
+        'since': MIN_KEY if since is None else since,
+        'until': MAX_KEY if until is None else until,
+    }
+    t0 = time.perf_counter()
+    if names is None:
+        connection.execute("INSERT INTO temp.purge_victims_t " + PURGE_WINDOWS_ALL, params)
+    else:
+        for name in names:
+            params['name'] = name
+            connection.execute("INSERT INTO temp.purge_victims_t " + PURGE_WINDOWS_BY_NAME, params)
+    connection.execute("CREATE INDEX IF NOT EXISTS temp.purge_victims_i ON purge_victims_t (name)")
+    count = connection.execute("SELECT COUNT(*) FROM temp.purge_victims_t").fetchone()[0]
+    log.info("%d readings to purge found in %.1f seconds", count, time.perf_counter() - t0)
+    return count
+
+
+def victims(connection, name):
+    '''
+    Readings to purge of a photometer, in time order, as found by window_victims().
+    A reading is repeated as many times as zero windows it was found in,
+    just like the FIFO filter would do. Readings are followed by their position
+    among the readings of their tess_id.
+    '''
+    for row in connection.execute(PURGE_VICTIMS, {'name': name}):
+        for i in range(row[-1]):
+            yield row[:-1]
+
+
+def zero_windows(magnitudes):
+    '''
+    Vectorized version of the FIFO filter for the magnitudes of a photometer, in time order.
+    Returns the number of zero windows found for every reading, computed from the
+    cumulative count of non zero magnitudes, so that any window is a single subtraction.
+    Edge readings are handled like window_victims() does. Requires NumPy.
+    '''
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("The numpy purge engine needs numpy. Install tessdb-utils[purge]")
+    n = len(magnitudes)
+    hits = numpy.zeros(n, dtype=numpy.int64)
+    if n <= HALF_WINDOW:
+        return hits
+    nonzero = numpy.concatenate(([0], numpy.cumsum(numpy.asarray(magnitudes) != 0)))
+    # Centered windows
+    j = numpy.arange(HALF_WINDOW + 1, n - HALF_WINDOW)
+    hits[j] = (nonzero[j + HALF_WINDOW + 1] - nonzero[j - HALF_WINDOW]) == 0
+    # The first checked reading sees the windows growing from the start
+    k = numpy.arange(HALF_WINDOW, min(2*HALF_WINDOW, n - 1) + 1)
+    hits[HALF_WINDOW] = numpy.count_nonzero(nonzero[k + 1] == 0)
+    return hits
+
+
+def array_victims(readings):
+    '''
+    Readings to purge among the (date_id, time_id, tess_id, sequence_number, frequency, magnitude)
+    readings of a photometer in time order, repeated and followed by their position like victims() does.
+    '''
+    rows = list(readings)
+    hits = zero_windows([row[5] for row in rows])
+    # Only once zero_windows() made sure that the optional numpy is there
+    import numpy
+    # Position of every reading among the readings of its tess_id
+    tess_ids = numpy.fromiter((row[2] for row in rows), dtype=numpy.int64, count=len(rows))
+    order = numpy.argsort(tess_ids, kind='stable')
+    starts = numpy.searchsorted(tess_ids[order], tess_ids[order])
+    positions = numpy.empty(len(rows), dtype=numpy.int64)
+    positions[order] = numpy.arange(len(rows)) - starts
+    for i in hits.nonzero()[0]:
+        for j in range(hits[i]):
+            yield rows[i] + (int(positions[i]),)
+
+
+def apply_deletes(connection, results, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Deletes the readings of the (name, readings) results directly, batch_size readings
+    per transaction, so that the database is only locked for short periods.
+    The last batch is committed even if the results are interrupted.
+    Returns the number of readings deleted.
+    '''
+    def commit(batch):
+        t0 = time.perf_counter()
+        cursor = connection.executemany(PURGE_DELETE, batch)
+        connection.commit()
+        log.info("Deleted %d readings in %.3f seconds", cursor.rowcount, time.perf_counter() - t0)
+        return cursor.rowcount
+    deleted = 0
+    batch = list()
+    try:
+        for name, readings in results:
+            # The FIFO filter may repeat readings
+            keys = dict.fromkeys((reading[0], reading[1], reading[2]) for reading in readings)
+            log.debug("[%s] %d readings to delete", name, len(keys))
+            for date_id, time_id, tess_id in keys:
+                batch.append({'date_id': date_id, 'time_id': time_id, 'tess_id': tess_id})
+                if len(batch) >= batch_size:
+                    deleted += commit(batch)
+                    batch = list()
+    finally:
+        # Also when interrupted, so that the readings of the photometers already analysed stay deleted
+        if batch:
+            deleted += commit(batch)
+        log.info("%d readings deleted", deleted)
+    return deleted
+
+
+def render_sql(reading, reason=None):
+    '''DELETE statement for a single reading, with the reason to delete it if given'''
+    date_id, time_id, tess_id, seqno, freq, mag = reading[:6]
+    reason = "" if reason is None else " ({0})".format(reason)
+    return ("DELETE FROM tess_readings_t WHERE date_id == {0} AND time_id == {1} AND tess_id == {2}; -- seq {3} freq {4} mag{5}{6}\n".format(date_id, time_id, tess_id, seqno, freq, mag, reason))
+
+
+def coalesce(readings):
+    '''
+    Groups the readings to purge of a photometer, followed by their position among the
+    readings of their tess_id, into runs of consecutive readings of the same tess_id.
+    No other reading of that tess_id lies in between, so every run can be deleted
+    by (date_id, time_id) range. Yields (first, last, count) tuples, in tess_id order.
+    Repeated readings are counted once.
+    '''
+    first = last = None
+    count = 0
+    for reading in sorted(readings, key=lambda reading: (reading[2], reading[-1])):
+        if last is not None and reading[2] == last[2] and reading[-1] - last[-1] in (0, 1):
+            if reading[-1] != last[-1]:
+                count += 1
+            last = reading
+            continue
+        if last is not None:
+            yield first, last, count
+        first = last = reading
+        count = 1
+    if last is not None:
+        yield first, last, count
+
+
+def render_range(first, last, count):
+    '''DELETE statement for a run of readings, as given by coalesce()'''
+    if count == 1:
+        return render_sql(first)
+    return ("DELETE FROM tess_readings_t WHERE tess_id == {0} AND (date_id, time_id) BETWEEN ({1}, {2}) AND ({3}, {4}); -- {5} readings\n".format(
+        first[2], first[0], first[1], last[0], last[1], count))
+
+
+def chunk_path(path, number):
+    '''purge.sql.gz -> purge.0001.sql.gz'''
+    suffix = ''
+    if path.endswith('.gz'):
+        path, suffix = path[:-3], '.gz'
+    root, ext = os.path.splitext(path)
+    return "{0}.{1:04d}{2}{3}".format(root, number, ext, suffix)
+
+# -------
+# Classes
+# -------
+
+class ScriptWriter:
+    '''
+    SQL script, each file wrapped in its own transaction. Files whose name ends
+    in .gz are gzip compressed. If split is given, a new numbered file is started
+    every split DELETE statements.
+    '''
+
+    def __init__(self, path, split=None):
+        self.path = path
+        self.split = split
+        self.fd = None
+        self.files = 0
+        self.statements = 0
+
+    def open(self):
+        path = chunk_path(self.path, self.files + 1) if self.split else self.path
+        self.fd = gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')
+        self.fd.write("BEGIN TRANSACTION;\n")
+        self.files += 1
+        log.debug("Writing SQL file %s", path)
+
+    def commit(self):
+        self.fd.write("COMMIT;\n")
+        self.fd.close()
+        self.fd = None
+
+    def close(self):
+        # There is always at least one file, even if empty
+        if self.fd is None and self.files == 0:
+            self.open()
+        if self.fd is not None:
+            self.commit()
+
+    def comment(self, text):
+        if self.fd is None:
+            self.open()
+        self.fd.write("-- {0}\n".format(text))
+
+    def delete(self, sql):
+        if self.fd is None:
+            self.open()
+        self.fd.write(sql)
+        self.statements += 1
+        if self.split and self.statements % self.split == 0:
+            self.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Telemetry:
+    '''
+    Aggregated purge telemetry, instead of logging every reading: per photometer counters
+    of scanned, kept, discarded and window flushed readings, elapsed times, and a sample
+    of reading traces. Telemetry gathered in worker processes is merged back.
+    If log_all is set, trace() tells the caller to log every reading, as it used to.
+    '''
+
+    def __init__(self, first=DEFAULT_TRACE_FIRST, every=DEFAULT_TRACE_EVERY, log_all=False):
+        self.first = first
+        self.every = every
+        self.log_all = log_all
+        self.counters = dict()
+        self.seconds = collections.Counter()
+        self.traced = collections.Counter()
+        self.samples = list()
+
+    def count(self, name, key, n=1):
+        if name not in self.counters:
+            self.counters[name] = collections.Counter()
+        self.counters[name][key] += n
+
+    def trace(self, name, reading, mark):
+        '''Keeps a sample of the reading traces. Returns True if the reading should be logged'''
+        if self.log_all:
+            return True
+        self.traced[name] += 1
+        n = self.traced[name]
+        if n <= self.first or n % self.every == 0:
+            self.samples.append({
+                'name': name, 'tess_id': reading[2], 'date_id': reading[0], 'time_id': reading[1],
+                'sequence_number': reading[3], 'frequency': reading[4], 'magnitude': reading[5], 'mark': mark,
+            })
+        return False
+
+    def photometer(self, name, victims, seconds, scanned=None):
+        '''Accounts the outcome of a photometer. Repeated readings are discarded only once'''
+        discarded = len(set(victim[:3] for victim in victims))
+        self.count(name, 'discarded', discarded)
+        if scanned is not None:
+            self.count(name, 'scanned', scanned)
+        if 'scanned' in self.counters[name]:
+            self.counters[name]['kept'] = self.counters[name]['scanned'] - self.counters[name]['discarded']
+        self.seconds[name] += seconds
+
+    def merge(self, other):
+        for name, counters in other.counters.items():
+            self.counters.setdefault(name, collections.Counter()).update(counters)
+        self.seconds.update(other.seconds)
+        self.samples.extend(other.samples)
+
+    def summary(self):
+        '''Per photometer rows plus a final row with the totals'''
+        rows = list()
+        totals = collections.Counter()
+        for name, counters in self.counters.items():
+            row = {'name': name}
+            row.update({key: counters.get(key) for key in TELEMETRY_COUNTERS})
+            row['seconds'] = self.seconds[name]
+            row['rows_per_second'] = counters['scanned'] / self.seconds[name] if counters.get('scanned') and self.seconds[name] else None
+            totals.update({key: value for key, value in row.items() if isinstance(value, (int, float)) and key != 'rows_per_second'})
+            rows.append(row)
+        total = {'name': 'Total'}
+        total.update({key: totals.get(key) for key in TELEMETRY_COUNTERS + ('seconds',)})
+        total['rows_per_second'] = totals['scanned'] / totals['seconds'] if totals.get('scanned') and totals['seconds'] else None
+        return rows, total
+
+    def table(self):
+        rows, total = self.summary()
+        headers = ('name',) + TELEMETRY_COUNTERS + ('seconds', 'rows_per_second')
+        table = [[row[key] for key in headers] for row in rows + [total]]
+        return tabulate.tabulate(table, headers=headers, floatfmt='.1f', missingval='-')
+
+    def save(self, path):
+        rows, total = self.summary()
+        with open(path, 'w') as fd:
+            json.dump({'photometers': rows, 'total': total, 'samples': self.samples}, fd, indent=2)
@@ -0,0 +1,192 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import collections
+
+# ----------------
+# Module constants
+# ----------------
+
+# A registered query, with sample parameters and the indexes that would best serve it,
+# given as (table, (column, ...)) tuples
+Query = collections.namedtuple('Query', ['sql', 'params', 'indexes'])
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# All the SQL run by the package and the maintenance scripts, checked by 'db explain'
+QUERIES = dict()
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def register(name, sql, params=None, indexes=()):
+    '''Registers a query by name and returns its SQL text'''
+    QUERIES[name] = Query(sql, params or dict(), tuple(indexes))
+    return sql
+
+# -------
+# Queries
+# -------
+
+REGISTRY_PHOTOMETERS = register('registry.photometers',
+    '''
+    SELECT t.name, t.tess_id, t.mac_address, t.valid_state, l.site, l.location
+    FROM tess_t AS t
+    LEFT JOIN location_t AS l USING (location_id)
+    ORDER BY t.tess_id ASC
+    ''')
+
+LOCATION_EXISTS = register('location.exists',
+    '''
+    SELECT COUNT(*) FROM location_t WHERE site = :site
+    ''',
+    params={'site': 'Unknown'},
+    indexes=[('location_t', ('site',))])
+
+LOCATION_CREATE = register('location.create',
+    '''
+    INSERT INTO location_t (site, longitude, latitude, elevation)
+    SELECT :site, :longitude, :latitude, :elevation
+    WHERE NOT EXISTS (SELECT 1 FROM location_t WHERE site = :site)
+    ''',
+    params={'site': 'Unknown', 'longitude': 0.0, 'latitude': 0.0, 'elevation': 0.0},
+    indexes=[('location_t', ('site',))])
+
+PHOTOMETER_ASSIGN = register('location.assign',
+    '''
+    UPDATE tess_t SET location_id = (SELECT location_id FROM location_t WHERE site = :site)
+    WHERE name = :name AND valid_state = 'Current'
+    ''',
+    params={'site': 'Unknown', 'name': None},
+    indexes=[('tess_t', ('name', 'valid_state')), ('location_t', ('site',))])
+
+PHOTOMETER_ENABLE = register('location.enable',
+    '''
+    UPDATE tess_t SET authorised = 1
+    WHERE name = :name AND valid_state = 'Current'
+    ''',
+    params={'name': None},
+    indexes=[('tess_t', ('name', 'valid_state'))])
+
+# Readings of a tess_id range in chunks, optionally with further columns
+_READINGS_CHUNK = '''
+    SELECT date_id, time_id, tess_id, sequence_number, frequency, magnitude{0}
+    FROM tess_readings_t
+    WHERE (tess_id, date_id, time_id) > (:tess_id, :date_id, :time_id)
+    AND tess_id <= :last
+    AND date_id BETWEEN :since AND :until
+    ORDER BY tess_id ASC, date_id ASC, time_id ASC
+    LIMIT :chunk
+    '''
+
+READINGS_CHUNK = register('readings.chunk', _READINGS_CHUNK.format(''),
+    params={'tess_id': 0, 'date_id': 0, 'time_id': 0, 'last': 0, 'since': 0, 'until': 99999999, 'chunk': 1000},
+    indexes=[('tess_readings_t', ('tess_id', 'date_id', 'time_id'))])
+
+READINGS_CHUNK_TEMPERATURES = register('readings.chunk.temperatures', _READINGS_CHUNK.format(', ambient_temperature, sky_temperature'),
+    params={'tess_id': 0, 'date_id': 0, 'time_id': 0, 'last': 0, 'since': 0, 'until': 99999999, 'chunk': 1000},
+    indexes=[('tess_readings_t', ('tess_id', 'date_id', 'time_id'))])
+
+# All the readings of a photometer in time order, streamed with a single query. Only used
+# when the (tess_id, date_id, time_id) index is missing, walking the primary key instead
+_READINGS_BY_NAME = '''
+    SELECT r.date_id, r.time_id, r.tess_id, r.sequence_number, r.frequency, r.magnitude{0}
+    FROM tess_readings_t AS r
+    JOIN tess_t AS i USING (tess_id)
+    WHERE i.name == :name
+    AND r.date_id BETWEEN :since AND :until
+    ORDER BY r.date_id ASC, r.time_id ASC, r.tess_id ASC
+    '''
+
+READINGS_BY_NAME = register('readings.by_name', _READINGS_BY_NAME.format(''),
+    params={'name': None, 'since': 0, 'until': 99999999},
+    indexes=[('tess_readings_t', ('tess_id', 'date_id', 'time_id'))])
+
+READINGS_BY_NAME_TEMPERATURES = register('readings.by_name.temperatures',
+    _READINGS_BY_NAME.format(', r.ambient_temperature, r.sky_temperature'),
+    params={'name': None, 'since': 0, 'until': 99999999},
+    indexes=[('tess_readings_t', ('tess_id', 'date_id', 'time_id'))])
+
+# Readings in a window of 7 consecutive readings of a photometer (3 before and 3 after)
+# whose magnitudes add up to zero. The rows at the edges are evaluated the same way as
+# the original FIFO purge filter: the first three and last three readings are never
+# deleted, and the fourth one is checked against the growing windows ending at the
+# fourth to seventh readings, counting a hit for each zero window found.
+# Non zero magnitudes are counted rather than added up: sliding SUM() frames of REAL
+# values accumulate rounding errors and never get back to an exact zero. Both tests
+# are the same for the always positive magnitudes.
+_PURGE_WINDOWS = '''
+    WITH windows AS (
+        SELECT i.name, r.date_id, r.time_id, r.tess_id, r.sequence_number, r.frequency, r.magnitude,
+            ROW_NUMBER() OVER w - 1 AS rn,
+            ROW_NUMBER() OVER (PARTITION BY r.tess_id ORDER BY r.date_id, r.time_id) - 1 AS position,
+            COUNT(*) OVER (PARTITION BY i.name) AS n,
+            SUM(r.magnitude <> 0) OVER (w ROWS BETWEEN 3 PRECEDING AND CURRENT ROW) AS s0,
+            SUM(r.magnitude <> 0) OVER (w ROWS BETWEEN 3 PRECEDING AND 1 FOLLOWING) AS s1,
+            SUM(r.magnitude <> 0) OVER (w ROWS BETWEEN 3 PRECEDING AND 2 FOLLOWING) AS s2,
+            SUM(r.magnitude <> 0) OVER (w ROWS BETWEEN 3 PRECEDING AND 3 FOLLOWING) AS s3
+        FROM tess_readings_t AS r
+        JOIN tess_t AS i USING (tess_id)
+        WHERE r.date_id BETWEEN :since AND :until
+        {0}
+        WINDOW w AS (PARTITION BY i.name ORDER BY r.date_id, r.time_id, r.tess_id)
+    ), hits AS (
+        SELECT name, date_id, time_id, tess_id, sequence_number, frequency, magnitude, position,
+            CASE
+                WHEN rn = 3 THEN (s0 = 0) + (n > 4 AND s1 = 0) + (n > 5 AND s2 = 0) + (n > 6 AND s3 = 0)
+                WHEN rn BETWEEN 4 AND n - 4 THEN s3 = 0
+                ELSE 0
+            END AS hits
+        FROM windows
+    )
+    SELECT name, date_id, time_id, tess_id, sequence_number, frequency, magnitude, position, hits
+    FROM hits
+    WHERE hits > 0
+    '''
+
+PURGE_DELETE = register('purge.delete',
+    '''
+    DELETE FROM tess_readings_t WHERE date_id = :date_id AND time_id = :time_id AND tess_id = :tess_id
+    ''',
+    params={'date_id': 0, 'time_id': 0, 'tess_id': 0},
+    indexes=[('tess_readings_t', ('tess_id', 'date_id', 'time_id'))])
+
+# The temporary victims table only exists while purging, so these are not registered either
+PURGE_VICTIMS_TABLE = '''
+    CREATE TEMP TABLE IF NOT EXISTS purge_victims_t (
+        name            TEXT,
+        date_id         INTEGER,
+        time_id         INTEGER,
+        tess_id         INTEGER,
+        sequence_number INTEGER,
+        frequency       REAL,
+        magnitude       REAL,
+        position        INTEGER,
+        hits            INTEGER
+    )
+    '''
+
+# The whole table is scanned on purpose, so this one is not registered
+PURGE_WINDOWS_ALL = _PURGE_WINDOWS.format('')
+
+PURGE_WINDOWS_BY_NAME = register('purge.windows', _PURGE_WINDOWS.format('AND i.name = :name'),
+    params={'name': None, 'since': 0, 'until': 99999999},
+    indexes=[('tess_t', ('name',)), ('tess_readings_t', ('tess_id', 'date_id', 'time_id'))])
+
+PURGE_VICTIMS = '''
+    SELECT date_id, time_id, tess_id, sequence_number, frequency, magnitude, position, hits
+    FROM temp.purge_victims_t
+    WHERE name = :name
+    ORDER BY date_id ASC, time_id ASC, tess_id ASC
+    '''
@@ -0,0 +1,320 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import sys
+import time
+import heapq
+import logging
+import datetime
+import functools
+import contextlib
+import collections
+import concurrent.futures
+
+#--------------
+# local imports
+# -------------
+
+from .utils import snapshot, open_database, log_statistics, paging, fetch_rows, EXPORT_LINES
+from .queries import READINGS_CHUNK, READINGS_CHUNK_TEMPERATURES, READINGS_BY_NAME, READINGS_BY_NAME_TEMPERATURES
+from .registry import registry
+from .db import index_exists
+
+# ----------------
+# Module constants
+# ----------------
+
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+MIN_KEY = -(2**63)
+MAX_KEY = 2**63 - 1
+
+# Chunked scans need an index starting with these columns, the primary key being (date_id, time_id, tess_id)
+READINGS_INDEX = ('tess_id', 'date_id', 'time_id')
+
+# Streamed per photometer queries used instead of the chunked ones without that index
+FALLBACK_QUERIES = {
+    READINGS_CHUNK: READINGS_BY_NAME,
+    READINGS_CHUNK_TEMPERATURES: READINGS_BY_NAME_TEMPERATURES,
+}
+
+# Seconds within which a repeated sequence number is a duplicate reading
+DEFAULT_TOLERANCE = 15
+
+DUPLICATE_HEADERS = ('name', 'date_id', 'time_id', 'tess_id', 'sequence_number', 'frequency', 'magnitude',
+    'previous_date_id', 'previous_time_id', 'previous_tess_id')
+
+FILTER_HEADERS = ('name', 'date_id', 'time_id', 'tess_id', 'sequence_number', 'frequency', 'magnitude',
+    'ambient_temperature', 'sky_temperature', 'reasons')
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger('readings')
+
+# Per worker process state
+_worker_context = None
+_worker_connection = None
+
+# -------
+# Classes
+# -------
+
+class ReadingsScanner:
+    '''
+    Walks tess_readings_t in (tess_id, date_id, time_id) order, in chunks of a few
+    thousand rows fetched with keyset pagination. Each chunk is a short query read
+    in full, so no cursor stays open and, outside an explicit transaction, the read
+    lock is released between chunks.
+    Yields (date_id, time_id, tess_id, sequence_number, frequency, magnitude) rows,
+    followed by (ambient_temperature, sky_temperature) with the READINGS_CHUNK_TEMPERATURES query.
+    The position attribute holds the key of the last row yielded and can be given
+    back as start to resume an interrupted scan right after it.
+    Chunks are range searches on a (tess_id, date_id, time_id) index, which must exist.
+    '''
+
+    def __init__(self, connection, first=None, last=None, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE, start=None, query=READINGS_CHUNK):
+        if not has_readings_index(connection):
+            # Every chunk would sort all the readings in the date range,
+            # so the cost of a scan would grow with chunks x table size
+            raise ValueError("tess_readings_t has no ({0}) index, needed to scan the readings in chunks. "
+                "Create it with 'tessutils db explain --create'".format(", ".join(READINGS_INDEX)))
+        self.connection = connection
+        self.query = query
+        self.last = MAX_KEY if last is None else last
+        self.since = MIN_KEY if since is None else since
+        self.until = MAX_KEY if until is None else until
+        self.chunk_size = chunk_size
+        if start is not None:
+            self.position = tuple(start)
+        else:
+            # Just before the first row of interest
+            self.position = (MIN_KEY if first is None else first, self.since, MIN_KEY)
+        self.chunks = 0
+        self.rows = 0
+
+    def __iter__(self):
+        while True:
+            tess_id, date_id, time_id = self.position
+            params = {
+                'tess_id': tess_id, 'date_id': date_id, 'time_id': time_id,
+                'last': self.last, 'since': self.since, 'until': self.until, 'chunk': self.chunk_size,
+            }
+            rows = self.connection.execute(self.query, params).fetchall()
+            if not rows:
+                break
+            self.chunks += 1
+            self.rows += len(rows)
+            self.connection.stats['readings'] += len(rows)
+            log.debug("Chunk %d: %d rows after %s", self.chunks, len(rows), self.position)
+            for row in rows:
+                self.position = (row[2], row[0], row[1])
+                yield row
+            if len(rows) < self.chunk_size:
+                break
+
+# -------------------------
+# Module auxiliar functions
+# -------------------------
+
+def has_readings_index(connection):
+    '''
+    Whether the readings can be scanned in chunks. The check is done once per connection,
+    warning when the index is missing.
+    '''
+    if not hasattr(connection, 'readings_index'):
+        connection.readings_index = index_exists(connection, 'tess_readings_t', READINGS_INDEX)
+        if not connection.readings_index:
+            log.warning("tess_readings_t has no (%s) index, reading photometers one query at a time. "
+                "Create it with 'tessutils db explain --create' for faster scans", ", ".join(READINGS_INDEX))
+    return connection.readings_index
+
+
+def streamed_readings(connection, query, params, arraysize):
+    '''Rows of a single query, fetched arraysize rows at a time'''
+    for row in fetch_rows(connection.execute(query, params), arraysize):
+        connection.stats['readings'] += 1
+        yield row
+
+
+def _worker_init(path, mode, pragmas):
+    '''Every worker process opens its own read only connection, kept for its whole life'''
+    global _worker_context, _worker_connection
+    _worker_context = contextlib.ExitStack()
+    _worker_connection = _worker_context.enter_context(snapshot(path, mode, pragmas=pragmas))
+
+
+def _worker_task(analysis, name):
+    connection = _worker_connection
+    readings = connection.stats['readings']
+    t0 = time.perf_counter()
+    result = analysis(connection, name)
+    return result, os.getpid(), connection.stats['readings'] - readings, time.perf_counter() - t0
+
+
+@functools.lru_cache(maxsize=1024)
+def day_seconds(date_id):
+    return datetime.date(date_id // 10000, date_id // 100 % 100, date_id % 100).toordinal() * 86400
+
+
+def reading_seconds(reading):
+    '''Seconds since the start of the proleptic Gregorian calendar of a (date_id, time_id, ...) reading'''
+    time_id = reading[1]
+    return day_seconds(reading[0]) + time_id // 10000 * 3600 + time_id // 100 % 100 * 60 + time_id % 100
+
+
+def log_throughput(workers):
+    for pid, (photometers, readings, seconds) in sorted(workers.items()):
+        rate = readings / seconds if seconds else 0
+        log.info("Worker %d: %d photometers, %d readings in %.1f seconds (%.0f readings/s)", pid, photometers, readings, seconds, rate)
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def database_file(connection):
+    '''Path of the main database file of a connection, e.g. a backup snapshot copy'''
+    return connection.execute("PRAGMA database_list").fetchone()[2]
+
+
+def photometer_readings(connection, name, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE, query=READINGS_CHUNK):
+    '''
+    All readings of a photometer in time order, merging the chunked scans of all its tess_id.
+    Without the readings index, a single query streams them instead.
+    '''
+    if not has_readings_index(connection):
+        params = {'name': name, 'since': MIN_KEY if since is None else since, 'until': MAX_KEY if until is None else until}
+        return streamed_readings(connection, FALLBACK_QUERIES[query], params, chunk_size)
+    scanners = [ReadingsScanner(connection, first=tess_id, last=tess_id, since=since, until=until, chunk_size=chunk_size, query=query)
+        for tess_id in registry(connection).tess_ids(name)]
+    return heapq.merge(*scanners, key=lambda reading: (reading[0], reading[1]))
+
+
+def find_duplicates(readings, tolerance=DEFAULT_TOLERANCE):
+    '''
+    Readings in time order whose sequence number already showed up at most tolerance
+    seconds before. Yields (reading, previous) pairs, previous being the last reading
+    with that sequence number. Only the readings of the last tolerance seconds are
+    kept in a sliding window, with a count of their sequence numbers, so this runs
+    in linear time and memory does not grow with the number of readings.
+    '''
+    window = collections.deque()
+    seen = dict()   # sequence_number -> [count in window, last reading]
+    for reading in readings:
+        seconds = reading_seconds(reading)
+        while window and window[0][0] < seconds - tolerance:
+            _, seqno = window.popleft()
+            entry = seen[seqno]
+            entry[0] -= 1
+            if entry[0] == 0:
+                del seen[seqno]
+        seqno = reading[3]
+        entry = seen.get(seqno)
+        if entry is None:
+            seen[seqno] = [1, reading]
+        else:
+            yield reading, entry[1]
+            entry[0] += 1
+            entry[1] = reading
+        window.append((seconds, seqno))
+
+
+def parallel_scan(path, names, analysis, workers=DEFAULT_WORKERS, mode='none', pragmas=None):
+    '''
+    Runs analysis(connection, name) for every photometer name in a pool of worker processes
+    and yields (name, result) pairs in the same order as names, whatever the order
+    in which workers finish. Each worker has its own read only connection, optionally
+    pinned to a WAL snapshot for its lifetime ('wal' mode). The analysis must be a
+    module level function (or a functools.partial of it) so that it can be pickled.
+    With a single worker everything runs in this process.
+    '''
+    throughput = collections.defaultdict(lambda: [0, 0, 0.0])
+    if workers <= 1:
+        _worker_init(path, mode, pragmas)
+        results = map(functools.partial(_worker_task, analysis), names)
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_worker_init, initargs=(path, mode, pragmas))
+        results = executor.map(functools.partial(_worker_task, analysis), names)
+    try:
+        for name, (result, pid, readings, seconds) in zip(names, results):
+            stats = throughput[pid]
+            stats[0] += 1
+            stats[1] += readings
+            stats[2] += seconds
+            yield name, result
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        else:
+            _worker_context.close()
+    log_throughput(throughput)
+
+
+# ===================
+# Module entry points
+# ===================
+
+def duplicates(options):
+    '''Reports or deletes readings repeating a sequence number within a few seconds'''
+    # Imported here as purge imports this module
+    from .purge import ScriptWriter, render_sql
+    connection = open_database(options.dbase, read_only=True, pragmas=options.pragma)
+    names = [options.name] if options.name else registry(connection).names()
+    found = collections.Counter()
+    def rows():
+        for name in names:
+            readings = photometer_readings(connection, name, options.since, options.until, options.chunk_size)
+            for reading, previous in find_duplicates(readings, options.tolerance):
+                found[name] += 1
+                yield (name,) + tuple(reading[:6]) + tuple(previous[:3])
+            if found[name]:
+                log.info("[%s] %d duplicate readings", name, found[name])
+    t0 = time.perf_counter()
+    if options.output:
+        with ScriptWriter(options.output) as writer:
+            for row in rows():
+                writer.delete(render_sql(row[1:]))
+    else:
+        paging(EXPORT_LINES[options.format](rows(), DUPLICATE_HEADERS), sys.stdout)
+    log.info("%d duplicate readings of %d photometers found in %.1f seconds", sum(found.values()), len(found), time.perf_counter() - t0)
+    log_statistics(log, connection)
+
+
+def filter(options):
+    '''Reports or deletes the readings failing any of the chosen filter rules, all checked in a single scan'''
+    # Imported here as purge imports this module
+    from .purge import ScriptWriter, render_sql
+    from .filters import make_rules, tag_readings
+    rules = make_rules(options.rule, options.frequency_range, options.ambient_range, options.sky_range)
+    log.info("Filter rules: %s", ", ".join(rule.code for rule in rules))
+    connection = open_database(options.dbase, read_only=True, pragmas=options.pragma)
+    names = [options.name] if options.name else registry(connection).names()
+    found = collections.Counter()
+    def rows():
+        for name in names:
+            readings = photometer_readings(connection, name, options.since, options.until, options.chunk_size, READINGS_CHUNK_TEMPERATURES)
+            for reading, codes in tag_readings(readings, rules):
+                found.update(codes)
+                yield (name,) + tuple(reading) + (",".join(codes),)
+    t0 = time.perf_counter()
+    if options.output:
+        with ScriptWriter(options.output) as writer:
+            for row in rows():
+                writer.delete(render_sql(row[1:], row[-1]))
+    else:
+        paging(EXPORT_LINES[options.format](rows(), FILTER_HEADERS), sys.stdout)
+    log.info("Readings discarded in %.1f seconds: %s", time.perf_counter() - t0,
+        ", ".join(f"{code}={found[code]}" for code in (rule.code for rule in rules)))
+    log_statistics(log, connection)
@@ -0,0 +1,106 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import collections
+import logging
+
+#--------------
+# local imports
+# -------------
+
+from .queries import REGISTRY_PHOTOMETERS
+
+# ----------------
+# Module constants
+# ----------------
+
+NAME_PREFIX = 'stars'
+
+Photometer = collections.namedtuple('Photometer', ['name', 'tess_id', 'mac_address', 'valid_state', 'site', 'location'])
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger('registry')
+
+# -------
+# Classes
+# -------
+
+class Registry:
+    '''
+    In-process cache of the photometer registry (tess_t rows with their location).
+    The few thousand rows are loaded once and reloaded only when the database changes,
+    either by another connection (PRAGMA data_version) or by this one (total_changes).
+    Hits and misses are accounted in the connection statistics.
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.version = None
+        self.rows = tuple()
+        self.by_name = dict()
+
+    def current_version(self):
+        return (self.connection.pragma('data_version'), self.connection.total_changes)
+
+    def photometers(self):
+        '''All registry rows, ordered by tess_id'''
+        version = self.current_version()
+        if version != self.version:
+            self.connection.stats['registry_misses'] += 1
+            cursor = self.connection.execute(REGISTRY_PHOTOMETERS)
+            self.rows = tuple(Photometer(*row) for row in cursor)
+            self.by_name = collections.defaultdict(list)
+            for row in self.rows:
+                self.by_name[row.name].append(row.tess_id)
+            self.version = version
+            log.debug("Loaded %d photometer registry rows", len(self.rows))
+        else:
+            self.connection.stats['registry_hits'] += 1
+        return self.rows
+
+    def invalidate(self):
+        self.version = None
+
+    def current(self):
+        return (row for row in self.photometers() if row.valid_state == 'Current' and (row.name or '').lower().startswith(NAME_PREFIX))
+
+    def unknown_location(self):
+        '''Name to tess_id index of the current photometers still without location'''
+        return {row.name: row.tess_id for row in self.current() if row.location == 'Unknown'}
+
+    def mac_addresses(self):
+        '''Name to MAC address index of the current photometers'''
+        return {row.name: row.mac_address for row in sorted(self.current(), key=lambda row: row.name)}
+
+    def names(self):
+        '''Distinct photometer names, in ascending order'''
+        self.photometers()
+        return sorted(name for name in self.by_name if name is not None)
+
+    def tess_ids(self, name):
+        '''All the tess_id of a photometer name, past and current'''
+        self.photometers()
+        return list(self.by_name.get(name, ()))
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def registry(connection):
+    '''The registry cache of a connection, created on first use'''
+    cache = getattr(connection, 'registry', None)
+    if cache is None:
+        cache = Registry(connection)
+        connection.registry = cache
+    return cache
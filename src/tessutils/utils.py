@@ -12,13 +12,24 @@
 # System wide imports
 # -------------------
 
+import re
+import csv
 import sys
+import json
+import time
+import logging
 import sqlite3
 import os
 import os.path
 import datetime
+import tempfile
+import functools
+import itertools
+import contextlib
+import collections
+import urllib.parse
 
-import tabulate
+import jinja2
 
 
 #--------------
@@ -33,6 +44,23 @@ import tabulate
 # package constants
 # ----------------
 
+# Applied to every connection unless overriden
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',      # readers do not block the tessdb writer and viceversa
+    'mmap_size':    268435456,  # 256 MiB
+    'cache_size':   -65536,     # negative values are KiB, i.e. 64 MiB
+    'temp_store':   'MEMORY',
+    'busy_timeout': 10000,      # milliseconds
+}
+
+SNAPSHOT_MODES = ('none', 'wal', 'backup')
+DEFAULT_SNAPSHOT_PAGES = 1024   # pages copied per backup step
+DEFAULT_SNAPSHOT_SLEEP = 0.05   # seconds between backup steps
+
+DEFAULT_ARRAYSIZE = 1000       # rows per fetchmany() call when streaming query results
+
+BYTECODE_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'tessutils', 'jinja2')
+
 
 # -----------------------
 # Module global variables
@@ -43,29 +71,277 @@ import tabulate
 # -----------------------
 
 
+# ==============
+# TEMPLATE STUFF
+# ==============
+
+@functools.lru_cache(maxsize=None)
+def template_environment(searchpath):
+    '''
+    One shared Jinja2 environment per template directory, so templates are compiled once per process.
+    Compiled templates are also kept in an on-disk bytecode cache between runs, if possible.
+    '''
+    try:
+        os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(BYTECODE_CACHE_DIR)
+    except OSError:
+        bytecode_cache = None
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath), bytecode_cache=bytecode_cache)
+
+
+def render(template_path, context, fd):
+    '''Renders the template straight into an open file, one chunk at a time'''
+    if not os.path.exists(template_path):
+        raise IOError("No Jinja2 template file found at {0}. Exiting ...".format(template_path))
+    path, filename = os.path.split(os.path.abspath(template_path))
+    template_environment(path).get_template(filename).stream(context).dump(fd)
+
+
 # ==============
 # DATABASE STUFF
 # ==============
 
-def open_database(path):
+class Cursor(sqlite3.Cursor):
+    '''Cursor accounting its statements in the connection statistics'''
+
+    def execute(self, sql, parameters=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.stats['statements'] += 1
+            self.connection.stats['execute_seconds'] += time.perf_counter() - t0
+
+    def executemany(self, sql, seq_of_parameters):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.stats['batches'] += 1
+            self.connection.stats['batch_rows'] += max(self.rowcount, 0)
+            self.connection.stats['execute_seconds'] += time.perf_counter() - t0
+
+
+class Connection(sqlite3.Connection):
+    '''SQLite connection keeping per connection statistics'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = collections.Counter()
+        self.opened = time.monotonic()
+
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def pragma(self, name, value=None):
+        if value is None:
+            return super().execute(f"PRAGMA {name}").fetchone()[0]
+        super().execute(f"PRAGMA {name} = {value}").fetchall()
+
+    def statistics(self):
+        stats = dict(self.stats)
+        stats['total_changes'] = self.total_changes
+        stats['open_seconds'] = time.monotonic() - self.opened
+        for name in ('journal_mode', 'mmap_size', 'cache_size', 'temp_store', 'busy_timeout', 'query_only', 'page_count'):
+            stats[name] = self.pragma(name)
+        return stats
+
+
+def pragma_setting(text):
+    '''Parses a NAME=VALUE PRAGMA setting from the command line'''
+    matchobj = re.match(r'^(\w+)=([\w.+-]+)$', text)
+    if not matchobj:
+        raise ValueError(f"Not a valid PRAGMA setting: {text}")
+    return matchobj.group(1), matchobj.group(2)
+
+
+def open_database(path, read_only=False, pragmas=None):
+    '''
+    Connection factory for all maintenance commands.
+    The default PRAGMAs can be overriden by a dictionary or sequence of (name, value) pairs.
+    Read only connections are opened through a mode=ro URI with query_only set.
+    query_only can be overriden to OFF to allow temporary tables on a read only connection.
+    '''
     if not os.path.exists(path):
         raise IOError("No SQLite3 Database file found in {0}. Exiting ...".format(path))
-    return sqlite3.connect(path)
- 
+    settings = dict(DEFAULT_PRAGMAS)
+    if read_only:
+        settings['query_only'] = 'ON'
+    settings.update(pragmas or dict())
+    if read_only:
+        uri = "file:{0}?mode=ro".format(urllib.parse.quote(os.path.abspath(path)))
+        connection = sqlite3.connect(uri, uri=True, factory=Connection)
+        # The journal mode cannot be changed without write access
+        settings.pop('journal_mode', None)
+    else:
+        connection = sqlite3.connect(path, factory=Connection)
+    for name, value in settings.items():
+        connection.pragma(name, value)
+    return connection
 
-def paging(cursor, headers, size=10):
+
+@contextlib.contextmanager
+def snapshot(path, mode='wal', pages=DEFAULT_SNAPSHOT_PAGES, sleep=DEFAULT_SNAPSHOT_SLEEP, pragmas=None, directory=None):
     '''
-    Pages query output and displays in tabular format
+    Read only connection for long analysis runs that never stalls the tessdb writer:
+    - wal:    a single read transaction pinned for the whole run. In WAL mode readers
+              do not block the writer and the pinned transaction gives a consistent view.
+    - backup: an online copy of the database taken with the backup API in throttled steps
+              of a few pages, sleeping in between, so that locks are held only briefly.
+              The analysis runs against the temporary copy, deleted afterwards.
+              In WAL mode the copy is taken within a pinned read transaction. Otherwise
+              SQLite restarts the copy whenever the database is written meanwhile.
+    - none:   a plain read only connection.
     '''
-    ONE_PAGE = 10
+    if mode == 'backup':
+        fd, copy_path = tempfile.mkstemp(suffix='.db', prefix='tess-snapshot-', dir=directory)
+        os.close(fd)
+        try:
+            source = open_database(path, read_only=True, pragmas=pragmas)
+            wal = source.pragma('journal_mode') == 'wal'
+            if wal:
+                # SQLite restarts the copy whenever the source is written, so it would never end
+                # while tessdb writes. A read transaction pinned for the whole copy keeps it on a
+                # single snapshot, and in WAL mode it does not block the writer
+                source.isolation_level = None
+                source.execute("BEGIN")
+                source.execute("SELECT COUNT(*) FROM sqlite_master").fetchall()
+            target = sqlite3.connect(copy_path)
+            t0 = time.perf_counter()
+            progress = {'remaining': None, 'restarts': 0}
+            def throttle(status, remaining, total):
+                # Without WAL the copy can only be restarted, as pinning a transaction would block the writer
+                if progress['remaining'] is not None and remaining > progress['remaining']:
+                    progress['restarts'] += 1
+                    logging.getLogger('utils').warning("Database snapshot restarted (%d) as %s was written meanwhile", progress['restarts'], path)
+                progress['remaining'] = remaining
+                # The backup API itself only sleeps when the database is busy or locked
+                if remaining:
+                    time.sleep(sleep)
+            source.backup(target, pages=pages, progress=throttle)
+            if wal:
+                source.execute("COMMIT")
+            target.close()
+            source.close()
+            logging.getLogger('utils').info("Database snapshot %s taken in %.1f seconds, %d restarts", copy_path, time.perf_counter() - t0, progress['restarts'])
+            connection = open_database(copy_path, read_only=True, pragmas=pragmas)
+            yield connection
+            connection.close()
+        finally:
+            os.remove(copy_path)
+    elif mode == 'wal':
+        connection = open_database(path, read_only=True, pragmas=pragmas)
+        if connection.pragma('journal_mode') != 'wal':
+            connection.close()
+            raise ValueError(f"{path} is not in WAL mode: a pinned read transaction would block the writer. Use a backup snapshot instead")
+        connection.isolation_level = None
+        connection.execute("BEGIN")
+        # BEGIN is deferred, the read snapshot is only taken on the first read
+        connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchall()
+        try:
+            yield connection
+        finally:
+            connection.execute("COMMIT")
+            connection.close()
+    else:
+        connection = open_database(path, read_only=True, pragmas=pragmas)
+        yield connection
+        connection.close()
+
+
+def log_statistics(log, connection):
+    stats = connection.statistics()
+    log.info("Database statistics: %s", ", ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" 
+        for key, value in stats.items()))
+ 
+
+# ============
+# EXPORT STUFF
+# ============
+
+class _Echo:
+    '''File-like object whose write() returns the text, so that csv.writer yields lines'''
+    def write(self, text):
+        return text
+
+
+def fetch_rows(cursor, arraysize=DEFAULT_ARRAYSIZE):
+    '''Streams the rows of an executed cursor, fetched arraysize rows at a time'''
+    cursor.arraysize = arraysize
     while True:
-        result = cursor.fetchmany(ONE_PAGE)
-        print(tabulate.tabulate(result, headers=headers, tablefmt='grid'))
-        if len(result) < ONE_PAGE:
-            break
-        size -= ONE_PAGE
-        if size > 0:
-            raw_input("Press Enter to continue [Ctrl-C to abort] ...")
-        else:
+        rows = cursor.fetchmany()
+        if not rows:
             break
+        yield from rows
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
 
+def _plain(value):
+    '''BLOBs are exported in hexadecimal'''
+    return value.hex() if isinstance(value, bytes) else value
+
+
+def csv_lines(rows, headers):
+    writer = csv.writer(_Echo(), lineterminator='\n')
+    yield writer.writerow(headers)
+    for row in rows:
+        yield writer.writerow(_plain(value) for value in row)
+
+
+def jsonl_lines(rows, headers):
+    for row in rows:
+        yield json.dumps(dict(zip(headers, row)), default=_json_default, ensure_ascii=False) + '\n'
+
+
+def table_lines(rows, headers, sample=DEFAULT_ARRAYSIZE):
+    '''
+    Aligned plain text table. Column widths are taken from the first sample rows
+    only, so that memory stays constant. Wider values further down just overflow.
+    '''
+    rows = iter(rows)
+    first = list(itertools.islice(rows, sample))
+    def text(value):
+        return '' if value is None else str(_plain(value))
+    widths = [len(header) for header in headers]
+    numeric = [True] * len(headers)
+    for row in first:
+        for i, value in enumerate(row):
+            widths[i] = max(widths[i], len(text(value)))
+            numeric[i] = numeric[i] and (value is None or isinstance(value, (int, float)))
+    def line(values):
+        return '  '.join(text(value).rjust(width) if num else text(value).ljust(width) 
+            for value, width, num in zip(values, widths, numeric)).rstrip() + '\n'
+    yield line(headers)
+    yield '  '.join('-' * width for width in widths) + '\n'
+    for row in itertools.chain(first, rows):
+        yield line(row)
+
+
+EXPORT_LINES = {'csv': csv_lines, 'jsonl': jsonl_lines, 'table': table_lines}
+
+
+def paging(lines, fd=sys.stdout, page_size=None):
+    '''
+    Writes lines to fd. If page_size is given, waits for the user every page_size lines.
+    Returns the number of lines written.
+    '''
+    count = 0
+    for count, line in enumerate(lines, start=1):
+        fd.write(line)
+        if page_size and count % page_size == 0:
+            fd.flush()
+            answer = input("-- More -- [Enter to continue, q to quit] ")
+            if answer.strip().lower().startswith('q'):
+                break
+    return count